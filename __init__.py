@@ -5,6 +5,7 @@ from trytond.pool import Pool
 from . import work
 from . import ir
 from . import configuration
+from . import electronic_mail
 
 def register():
     Pool.register(
@@ -14,13 +15,21 @@ def register():
         configuration.WorkConfiguration,
         configuration.ConfigurationEmployee,
         ir.Cron,
+        ir.Attachment,
         work.CreateResourceStart,
+        work.WorkActivityChange,
         work.WorkStatus,
         work.ActivityType,
         work.ActivityTimeSheetSync,
         work.TimesheetLine,
+        electronic_mail.ElectronicMail,
         module='project_activity', type_='model')
 
+    Pool.register(
+        work.WorkParty,
+        module='project_activity', type_='model',
+        depends=['project_contact'])
+
     Pool.register(
         work.ProjectActivityEmail,
         module='project_activity', type_='model',
@@ -1,8 +1,10 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+from trytond.cache import Cache
 from trytond.model import ModelSQL, fields
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
+from trytond.transaction import Transaction
 from trytond.modules.company.model import CompanyValueMixin
 
 
@@ -18,6 +20,9 @@ class WorkConfiguration(metaclass=PoolMeta):
     email_activity_mailbox = fields.Many2One('electronic.mail.mailbox',
         'E-mail Activity Mailbox', required=True)
     synchronize_activity_time = fields.Boolean('Synchronize Activity Time')
+    email_activity_last_mail = fields.Integer('E-mail Activity Last Mail',
+        readonly=True, help='Last e-mail checked by the cron')
+    _activity_cache = Cache('project.configuration.activity', context=False)
 
     @classmethod
     def multivalue_model(cls, field):
@@ -26,6 +31,40 @@ class WorkConfiguration(metaclass=PoolMeta):
             return pool.get('project.configuration.activity_employee')
         return super(WorkConfiguration, cls).multivalue_model(field)
 
+    @classmethod
+    def get_activity_values(cls):
+        "Return the activity values of the configuration for the company"
+        company = Transaction().context.get('company')
+        values = cls._activity_cache.get(company)
+        if values is not None:
+            return values
+        with Transaction().set_context(_check_access=False):
+            config = cls(1)
+            values = {
+                'synchronize_activity_time': bool(
+                    config.synchronize_activity_time),
+                }
+            for name in ['email_activity_type', 'email_activity_employee',
+                    'email_activity_mailbox']:
+                value = getattr(config, name)
+                values[name] = value.id if value else None
+        return cls._activity_cache.set(company, values)
+
+    @classmethod
+    def create(cls, vlist):
+        cls._activity_cache.clear()
+        return super().create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        cls._activity_cache.clear()
+
+    @classmethod
+    def delete(cls, records):
+        super().delete(records)
+        cls._activity_cache.clear()
+
 
 class ConfigurationEmployee(ModelSQL, CompanyValueMixin):
     "Activity Employee"
@@ -36,3 +75,24 @@ class ConfigurationEmployee(ModelSQL, CompanyValueMixin):
                         ('company', 'in',
                     [Eval('company', -1), None]),
             ], depends=['company'])
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Configuration = pool.get('project.configuration')
+        Configuration._activity_cache.clear()
+        return super().create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Configuration = pool.get('project.configuration')
+        super().write(*args)
+        Configuration._activity_cache.clear()
+
+    @classmethod
+    def delete(cls, records):
+        pool = Pool()
+        Configuration = pool.get('project.configuration')
+        super().delete(records)
+        Configuration._activity_cache.clear()
@@ -0,0 +1,29 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+
+class ElectronicMail(metaclass=PoolMeta):
+    __name__ = 'electronic.mail'
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Configuration = pool.get('project.configuration')
+        mails = super().create(vlist)
+        if not Transaction().context.get('_project_activity_thread', True):
+            return mails
+        mailbox = Configuration.get_activity_values()['email_activity_mailbox']
+        to_thread = [m for m in mails
+            if mailbox and m.mailbox and m.mailbox.id == mailbox
+            and m.in_reply_to and not m.flag_seen]
+        if to_thread:
+            cls.__queue__.create_activities(to_thread)
+        return mails
+
+    @classmethod
+    def create_activities(cls, mails):
+        pool = Pool()
+        Activity = pool.get('activity.activity')
+        Activity.create_mail_activities(mails)
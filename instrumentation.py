@@ -0,0 +1,151 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""Instrumentation of the hot paths of the module
+
+It is enabled in the configuration file of trytond with::
+
+    [project_activity]
+    instrumentation = True
+    slow_threshold = 1.0
+
+When it is disabled, the instrumented functions are not wrapped at all.
+"""
+import logging
+import threading
+import time
+from collections import defaultdict
+from functools import wraps
+
+from trytond.config import config
+from trytond.transaction import Transaction
+
+__all__ = ['instrument', 'metrics', 'format_metrics']
+
+logger = logging.getLogger(__name__)
+
+ENABLED = config.getboolean(
+    'project_activity', 'instrumentation', default=False)
+# in seconds
+SLOW_THRESHOLD = config.getfloat(
+    'project_activity', 'slow_threshold', default=1.0)
+
+_lock = threading.Lock()
+_metrics = defaultdict(lambda: {
+        'calls': 0,
+        'records': 0,
+        'seconds': 0.0,
+        'queries': 0,
+        })
+_local = threading.local()
+
+
+def _count_query():
+    for counter in getattr(_local, 'counters', []):
+        counter[0] += 1
+
+
+class _CountingCursor:
+    "Count the queries executed by the wrapped cursor"
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        self._cursor.__enter__()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return self._cursor.__exit__(type, value, traceback)
+
+    def execute(self, *args, **kwargs):
+        _count_query()
+        return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        _count_query()
+        return self._cursor.executemany(*args, **kwargs)
+
+
+class _CountingConnection:
+    "Wrap the cursors of the connection to count their queries"
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def cursor(self, *args, **kwargs):
+        return _CountingCursor(self._connection.cursor(*args, **kwargs))
+
+
+def instrument(name):
+    "Decorate a method to record its metrics under name"
+    def decorator(func):
+        if not ENABLED:
+            return func
+
+        @wraps(func)
+        def wrapper(cls, *args, **kwargs):
+            counters = _local.__dict__.setdefault('counters', [])
+            counter = [0]
+            # Only the outermost call wraps the connection of the
+            # transaction, the nested ones share its counting
+            transaction = Transaction()
+            connection = transaction.connection
+            wrap = not counters and connection is not None
+            if wrap:
+                transaction.connection = _CountingConnection(connection)
+            counters.append(counter)
+            start = time.perf_counter()
+            try:
+                return func(cls, *args, **kwargs)
+            finally:
+                duration = time.perf_counter() - start
+                counters.pop()
+                if wrap:
+                    transaction.connection = connection
+                records = (len(args[0])
+                    if args and isinstance(args[0], (list, tuple)) else 0)
+                with _lock:
+                    values = _metrics[name]
+                    values['calls'] += 1
+                    values['records'] += records
+                    values['seconds'] += duration
+                    values['queries'] += counter[0]
+                if duration >= SLOW_THRESHOLD:
+                    logger.warning(
+                        'slow call name=%s records=%d seconds=%.3f '
+                        'queries=%d', name, records, duration, counter[0])
+        return wrapper
+    return decorator
+
+
+def metrics():
+    "Return a copy of the metrics by name"
+    with _lock:
+        return {n: v.copy() for n, v in _metrics.items()}
+
+
+def format_metrics():
+    "Return the metrics in the Prometheus text format"
+    lines = []
+    values = metrics()
+    for key, type_, help_ in [
+            ('calls', 'counter', "Number of calls"),
+            ('records', 'counter', "Number of records processed"),
+            ('seconds', 'counter', "Wall time spent in seconds"),
+            ('queries', 'counter', "Number of SQL queries executed"),
+            ]:
+        metric = 'project_activity_%s_total' % key
+        lines.append('# HELP %s %s' % (metric, help_))
+        lines.append('# TYPE %s %s' % (metric, type_))
+        for name, value in sorted(values.items()):
+            lines.append('%s{name="%s"} %s' % (metric, name, value[key]))
+    return '\n'.join(lines) + '\n'
@@ -1,7 +1,15 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 
-from trytond.pool import PoolMeta
+import hashlib
+from itertools import chain
+
+from sql import Null
+
+from trytond.model import Index, fields
+from trytond.pool import Pool, PoolMeta
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
 
 class Cron(metaclass=PoolMeta):
     __name__ = 'ir.cron'
@@ -11,4 +19,133 @@ class Cron(metaclass=PoolMeta):
         super().__setup__()
         cls.method.selection += [
             ('activity.activity|cron_get_mail_activity','Electronic Mail Cron'),
+            ('activity.activity|archive_descriptions',
+                'Archive Activity Descriptions'),
+            ('project.work.activity.change|clean',
+                'Clean Activity Changes'),
             ]
+
+
+class Attachment(metaclass=PoolMeta):
+    __name__ = 'ir.attachment'
+    data_hash = fields.Char("Data Hash", readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        table = cls.__table__()
+        cls._sql_indexes.add(
+            Index(
+                table,
+                (table.data_hash, Index.Equality()),
+                where=table.data_hash != Null))
+
+    @classmethod
+    def copy(cls, attachments, default=None):
+        if default is None:
+            default = {}
+        else:
+            default = default.copy()
+        default.setdefault('data_hash')
+        return super().copy(attachments, default=default)
+
+    @classmethod
+    def deduplicate(cls, attachments, data):
+        "Share the stored file of activity attachments with the same data"
+        pool = Pool()
+        Activity = pool.get('activity.activity')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        digests, no_data = {}, []
+        for attachment, value in zip(attachments, data):
+            if (isinstance(attachment.resource, Activity)
+                    and attachment.type == 'data'
+                    and value is not None):
+                digests[attachment.id] = hashlib.sha256(
+                    cls.data.cast(value)).hexdigest()
+            else:
+                no_data.append(attachment.id)
+        for sub_ids in grouped_slice(no_data):
+            cursor.execute(*table.update([table.data_hash], [Null],
+                    where=reduce_ids(table.id, sub_ids)
+                    & (table.data_hash != Null)))
+        if not digests:
+            return
+
+        file_ids = {}
+        if cls.data.file_id:
+            for sub_digests in grouped_slice(set(digests.values())):
+                cursor.execute(*table.select(
+                        table.data_hash, table.file_id,
+                        where=table.data_hash.in_(list(sub_digests))
+                        & (table.file_id != Null)
+                        & ~table.id.in_(list(digests)),
+                        order_by=[table.id.asc]))
+                for digest, file_id in cursor:
+                    file_ids.setdefault(digest, file_id)
+            for sub_ids in grouped_slice(list(digests)):
+                cursor.execute(*table.select(table.id, table.file_id,
+                        where=reduce_ids(table.id, sub_ids),
+                        order_by=[table.id.asc]))
+                for id_, file_id in cursor.fetchall():
+                    digest = digests[id_]
+                    if digest not in file_ids:
+                        file_ids[digest] = file_id
+                    elif file_ids[digest] != file_id:
+                        # The duplicated file is removed by the filestore
+                        # queue once no attachment refers to it
+                        cls.data.queue_for_removal(cls, 'data', [id_])
+
+        for id_, digest in digests.items():
+            columns, values = [table.data_hash], [digest]
+            if digest in file_ids:
+                columns.append(table.file_id)
+                values.append(file_ids[digest])
+            cursor.execute(*table.update(columns, values,
+                    where=table.id == id_))
+
+    @classmethod
+    def _activity_ids(cls, attachments):
+        pool = Pool()
+        Activity = pool.get('activity.activity')
+        return {a.resource.id for a in attachments
+            if isinstance(a.resource, Activity)}
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Activity = pool.get('activity.activity')
+        attachments = super().create(vlist)
+        cls.deduplicate(attachments, [v.get('data') for v in vlist])
+        ids = list(cls._activity_ids(attachments))
+        Activity.update_attachment_count(ids)
+        Activity.log_work_changes(Activity.browse(ids))
+        return attachments
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Activity = pool.get('activity.activity')
+        attachments = list(chain(*args[::2]))
+        ids = cls._activity_ids(attachments)
+        super().write(*args)
+        attachments = cls.browse([a.id for a in attachments])
+        actions = iter(args)
+        for records, values in zip(actions, actions):
+            if 'data' in values:
+                records = cls.browse([r.id for r in records])
+                cls.deduplicate(records, [values['data']] * len(records))
+        ids |= cls._activity_ids(attachments)
+        Activity.update_attachment_count(list(ids))
+        Activity.log_work_changes(Activity.browse(list(ids)))
+
+    @classmethod
+    def delete(cls, attachments):
+        pool = Pool()
+        Activity = pool.get('activity.activity')
+        ids = cls._activity_ids(attachments)
+        super().delete(attachments)
+        Activity.update_attachment_count(list(ids))
+        Activity.log_work_changes(Activity.browse(list(ids)))
@@ -0,0 +1,577 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""Benchmarks of project_activity
+
+They must be run against a scratch SQLite or PostgreSQL database where
+project_activity is activated and project.configuration is filled::
+
+    python -m trytond.modules.project_activity.tests.benchmark \\
+        -c trytond.conf -d DATABASE --works 1000 --activities-per-work 50 \\
+        --output results.json --baseline baseline.json
+
+The lookups of the activities of a work are measured on a million
+activities with::
+
+    python -m trytond.modules.project_activity.tests.benchmark \\
+        -c trytond.conf -d DATABASE --works 1000 --activities-per-work 1000 \\
+        -k activities -k latest -k work.activities
+
+The synthetic data is generated with a fixed seed and committed so the
+database statistics are up to date when the benchmarks are timed. It can be
+reused by later runs with --no-generate. Every benchmark that modifies data
+runs in a transaction that is rolled back.
+
+The results are written as JSON and compared against the medians of a
+previous result file given as baseline. The exit status is 1 when one of
+them is slower than the baseline by more than the tolerance.
+"""
+import argparse
+import base64
+import datetime
+import itertools
+import json
+import random
+import secrets
+import statistics
+import sys
+import time
+
+from trytond import backend
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction, TransactionError
+
+CHUNK = 10000
+PREFIX = 'Benchmark'
+LOGIN = 'benchmark'
+DESCRIPTION = (
+    "Hello,\n\n"
+    "Could you check the attached document for %(subject)s?\n"
+    "See https://example.com/%(id)d for the details.\n\n"
+    "Regards\n\n"
+    "On Monday, someone wrote:\n"
+    "> The previous message of the conversation\n"
+    "> with a few quoted lines\n")
+LOGO = bytes(range(256)) * 64
+
+BENCHMARKS = []
+
+
+def benchmark(name, mode='read'):
+    """Register func as the benchmark name
+
+    mode is 'read' or 'write' for the kind of transaction in which func is
+    run or None if func starts its own transactions."""
+    def decorator(func):
+        BENCHMARKS.append((name, func, mode))
+        return func
+    return decorator
+
+
+def timeit(func, repeat):
+    "Return the durations in milliseconds of repeat calls to func"
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append((time.perf_counter() - start) * 1000)
+    return durations
+
+
+def summarize(durations):
+    durations = sorted(durations)
+    return {
+        'n': len(durations),
+        'min': durations[0],
+        'median': statistics.median(durations),
+        'p95': durations[max(int(len(durations) * 0.95) - 1, 0)],
+        'max': durations[-1],
+        }
+
+
+def report(name, stats, file=sys.stderr):
+    print('%-30s median %8.3f ms  p95 %8.3f ms  (n=%d)' % (
+            name, stats['median'], stats['p95'], stats['n']), file=file)
+
+
+def compare(results, baseline, tolerance):
+    "Print the ratio to the baseline and return the names of regressions"
+    regressions = []
+    for name, stats in sorted(results.items()):
+        if name not in baseline or not baseline[name]['median']:
+            continue
+        ratio = stats['median'] / baseline[name]['median']
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+        print('%-30s %6.2fx %s' % (
+                name, ratio, 'REGRESSION' if name in regressions else ''),
+            file=sys.stderr)
+    return regressions
+
+
+def generate_parties(count):
+    "Create count parties with an e-mail"
+    pool = Pool()
+    Party = pool.get('party.party')
+
+    return Party.create([{
+                'name': '%s contact %d' % (PREFIX, i),
+                'contact_mechanisms': [('create', [{
+                                'type': 'email',
+                                'value': 'contact%d@example.com' % i,
+                                }])],
+                } for i in range(count)])
+
+
+def generate_works(count, parties):
+    pool = Pool()
+    Company = pool.get('company.company')
+    Work = pool.get('project.work')
+
+    company, = Company.search([], limit=1)
+    return Work.create([{
+                'name': '%s %d' % (PREFIX, i),
+                'type': 'task',
+                'company': company.id,
+                'party': random.choice(parties).id if parties else None,
+                } for i in range(count)])
+
+
+def generate_activities(works, per_work):
+    "Insert per_work activities on each work bypassing the hooks"
+    pool = Pool()
+    Activity = pool.get('activity.activity')
+    Configuration = pool.get('project.configuration')
+    transaction = Transaction()
+    cursor = transaction.connection.cursor()
+
+    from ..work import conversation_parts
+
+    configuration = Configuration(1)
+    table = Activity.__table__()
+    columns = [
+        table.subject, table.description, table.conversation_body,
+        table.conversation_quoted, table.attachment_count, table.resource,
+        table.dtstart, table.activity_type, table.state, table.employee,
+        table.create_uid, table.create_date]
+    now = datetime.datetime.now()
+    rows = ((w, i) for i in range(per_work) for w in works)
+    while True:
+        values = []
+        for work, i in itertools.islice(rows, CHUNK):
+            subject = '%s %d-%d' % (PREFIX, work.id, i)
+            description = DESCRIPTION % {'subject': subject, 'id': i}
+            body, quoted = conversation_parts(description)
+            values.append([
+                    subject, description, body, quoted, 0, str(work),
+                    now - datetime.timedelta(minutes=i),
+                    configuration.email_activity_type.id,
+                    'done',
+                    configuration.email_activity_employee.id,
+                    0,
+                    now,
+                    ])
+        if not values:
+            break
+        cursor.execute(*table.insert(columns, values))
+    Activity.update_full_text()
+
+
+def generate_contacts(parties):
+    "Link each synthetic activity to a random contact"
+    pool = Pool()
+    Activity = pool.get('activity.activity')
+    field = Activity.contacts
+    Contact = field.get_target()
+    Relation = pool.get(field.relation_name)
+    cursor = Transaction().connection.cursor()
+
+    if 'party' in Contact._fields:
+        contacts = Contact.search([('party', 'in', [p.id for p in parties])])
+    else:
+        contacts = parties
+    if not contacts:
+        return
+    activity = Activity.__table__()
+    relation = Relation.__table__()
+    cursor.execute(*activity.select(activity.id,
+            where=activity.subject.like(PREFIX + ' %')))
+    activity_ids = [i for i, in cursor]
+    columns = [
+        getattr(relation, field.origin), getattr(relation, field.target),
+        relation.create_uid, relation.create_date]
+    now = datetime.datetime.now()
+    for sub_ids in grouped_slice(activity_ids, CHUNK):
+        cursor.execute(*relation.insert(columns, [
+                    [i, random.choice(contacts).id, 0, now]
+                    for i in sub_ids]))
+
+
+def generate_attachments(count):
+    "Create count attachments on activities sharing only two contents"
+    pool = Pool()
+    Activity = pool.get('activity.activity')
+    Attachment = pool.get('ir.attachment')
+    cursor = Transaction().connection.cursor()
+
+    table = Activity.__table__()
+    cursor.execute(*table.select(table.id,
+            where=table.subject.like(PREFIX + ' %')))
+    activity_ids = [i for i, in cursor]
+    if not activity_ids:
+        return
+    vlist = []
+    for i in range(count):
+        if i % 3:
+            name, data = 'report%d.txt' % i, (DESCRIPTION * 20).encode()
+        else:
+            name, data = 'logo%d.png' % i, LOGO
+        vlist.append({
+                'name': name,
+                'resource': 'activity.activity,%d' % random.choice(
+                    activity_ids),
+                'data': data,
+                })
+    for sub_vlist in grouped_slice(vlist, 1000):
+        Attachment.create(list(sub_vlist))
+
+
+def generate_mails(works, count, chain):
+    """Create count unseen mails replying to works in threads of chain mails
+
+    They are not queued for threading so they are left to the mail cron.
+    """
+    pool = Pool()
+    ElectronicMail = pool.get('electronic.mail')
+    Configuration = pool.get('project.configuration')
+
+    mailbox = Configuration.get_activity_values()['email_activity_mailbox']
+    if not mailbox or not works:
+        return
+    vlist = []
+    now = datetime.datetime.now()
+    for i in range(count):
+        if not i % chain:
+            work = random.choice(works)
+            references = ['<%d@example.com>' % work.id]
+        message_id = '<%s-%d@example.com>' % (PREFIX.lower(), i)
+        vlist.append({
+                'mailbox': mailbox,
+                'message_id': message_id,
+                'in_reply_to': references[-1],
+                'references': '\r\n\t'.join(references),
+                'subject': 'Re: %s %d' % (PREFIX, work.id),
+                'from_': 'contact%d@example.com' % (i % 10),
+                'date': now - datetime.timedelta(minutes=count - i),
+                'body_plain': DESCRIPTION % {'subject': work.name, 'id': i},
+                'flag_seen': False,
+                })
+        references.append(message_id)
+    with Transaction().set_context(_project_activity_thread=False):
+        ElectronicMail.create(vlist)
+
+
+def generate_user():
+    "Create the user with the groups of admin to call the routes"
+    pool = Pool()
+    User = pool.get('res.user')
+
+    password = secrets.token_urlsafe(16)
+    admin = User(1)
+    users = User.search([('login', '=', LOGIN)])
+    if users:
+        user, = users
+    else:
+        user = User(login=LOGIN, name=PREFIX)
+    user.groups = admin.groups
+    user.companies = admin.companies
+    user.company = admin.company
+    user.password = password
+    user.save()
+    return password
+
+
+def generate(options):
+    parties = generate_parties(options.contacts)
+    works = generate_works(options.works, parties)
+    generate_activities(works, options.activities_per_work)
+    generate_contacts(parties)
+    generate_attachments(options.attachments)
+    generate_mails(works, options.mails, options.mail_chain)
+
+
+def load_data():
+    "Return the ids of the synthetic data"
+    pool = Pool()
+    Attachment = pool.get('ir.attachment')
+    Work = pool.get('project.work')
+
+    works = Work.search([('name', 'like', PREFIX + ' %')])
+    attachments = Attachment.search([
+            ('resource', 'like', 'activity.activity,%'),
+            ('name', 'like', 'report%'),
+            ], limit=1000)
+    return {
+        'works': [w.id for w in works],
+        'attachments': [a.id for a in attachments],
+        }
+
+
+def sample(ids, repeat):
+    "Return an iterator over repeat ids drawn from ids"
+    ids = random.sample(ids, min(repeat, len(ids)))
+    return iter(ids * (repeat // len(ids) + 1))
+
+
+@benchmark('activities search')
+def bench_activities_search(data, options):
+    pool = Pool()
+    Activity = pool.get('activity.activity')
+    iterator = sample(data['works'], options.repeat)
+
+    def search():
+        Activity.search([('resource', '=', 'project.work,%d' % next(iterator))])
+    return timeit(search, options.repeat)
+
+
+@benchmark('latest activity')
+def bench_latest_activity(data, options):
+    pool = Pool()
+    Activity = pool.get('activity.activity')
+    iterator = sample(data['works'], options.repeat)
+
+    def latest():
+        Activity.search([
+                ('resource', '=', 'project.work,%d' % next(iterator)),
+                ], order=[('dtstart', 'DESC'), ('id', 'DESC')], limit=1)
+    return timeit(latest, options.repeat)
+
+
+@benchmark('work.activities read')
+def bench_one2many(data, options):
+    pool = Pool()
+    Work = pool.get('project.work')
+    iterator = sample(data['works'], options.repeat)
+
+    def one2many():
+        Work.read([next(iterator)], ['activities'])
+    return timeit(one2many, options.repeat)
+
+
+@benchmark('get_activity_fields')
+def bench_activity_fields(data, options):
+    pool = Pool()
+    Work = pool.get('project.work')
+    iterator = sample(data['works'], options.repeat * options.batch)
+    names = ['last_action_date', 'channel', 'contact_name']
+
+    def activity_fields():
+        works = Work.browse([next(iterator) for _ in range(options.batch)])
+        Work.get_activity_fields(works, names)
+    return timeit(activity_fields, options.repeat)
+
+
+@benchmark('conversation render')
+def bench_conversation(data, options):
+    pool = Pool()
+    Work = pool.get('project.work')
+    iterator = sample(data['works'], options.repeat)
+
+    def render():
+        work = Work(next(iterator))
+        Work.get_conversation_activities(
+            work.activities, collapse_attachments=True)
+    return timeit(render, options.repeat)
+
+
+@benchmark('cron_get_mail_activity', mode='write')
+def bench_cron(data, options):
+    pool = Pool()
+    Activity = pool.get('activity.activity')
+    transaction = Transaction()
+
+    def cron():
+        Activity.cron_get_mail_activity()
+    durations = []
+    for _ in range(options.repeat_slow):
+        durations.extend(timeit(cron, 1))
+        transaction.rollback()
+    return durations
+
+
+@benchmark('activity create', mode='write')
+def bench_create(data, options):
+    pool = Pool()
+    Activity = pool.get('activity.activity')
+    Configuration = pool.get('project.configuration')
+    transaction = Transaction()
+
+    configuration = Configuration(1)
+    now = datetime.datetime.now()
+
+    def create():
+        work_ids = itertools.islice(
+            sample(data['works'], options.batch), options.batch)
+        Activity.create([{
+                    'subject': '%s bulk %d' % (PREFIX, i),
+                    'description': DESCRIPTION % {
+                        'subject': PREFIX, 'id': i},
+                    'resource': 'project.work,%d' % work_id,
+                    'dtstart': now,
+                    'activity_type': configuration.email_activity_type.id,
+                    'state': 'done',
+                    'employee': configuration.email_activity_employee.id,
+                    } for i, work_id in enumerate(work_ids)])
+    durations = []
+    for _ in range(options.repeat_slow):
+        durations.extend(timeit(create, 1))
+        transaction.rollback()
+    return durations
+
+
+@benchmark('activity write', mode='write')
+def bench_write(data, options):
+    pool = Pool()
+    Activity = pool.get('activity.activity')
+    transaction = Transaction()
+
+    def write():
+        activities = Activity.search([
+                ('resource', 'in', [
+                        'project.work,%d' % i for i in random.sample(
+                            data['works'],
+                            min(options.batch, len(data['works'])))]),
+                ], limit=options.batch)
+        Activity.write(activities, {
+                'description': DESCRIPTION % {'subject': PREFIX, 'id': 0},
+                })
+    durations = []
+    for _ in range(options.repeat_slow):
+        durations.extend(timeit(write, 1))
+        transaction.rollback()
+    return durations
+
+
+@benchmark('attachment route', mode=None)
+def bench_attachment_route(data, options):
+    from werkzeug.test import Client
+
+    from trytond.wsgi import app
+
+    if not data['attachments'] or not options.password:
+        return []
+    client = Client(app)
+    credentials = base64.b64encode(
+        ('%s:%s' % (LOGIN, options.password)).encode()).decode()
+    headers = {
+        'Authorization': 'Basic ' + credentials,
+        'Accept-Encoding': 'gzip',
+        }
+    iterator = sample(data['attachments'], options.repeat)
+
+    def get():
+        response = client.get('/%s/ir/attachment/%d' % (
+                options.database, next(iterator)), headers=headers)
+        assert response.status_code == 200, response.status
+    return timeit(get, options.repeat)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-c', '--config', dest='config')
+    parser.add_argument('-d', '--database', dest='database', required=True)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--no-generate', dest='generate',
+        action='store_false', help="reuse the data of a previous run")
+    parser.add_argument('--works', type=int, default=1000)
+    parser.add_argument('--activities-per-work', type=int, default=50)
+    parser.add_argument('--contacts', type=int, default=200)
+    parser.add_argument('--attachments', type=int, default=2000)
+    parser.add_argument('--mails', type=int, default=500)
+    parser.add_argument('--mail-chain', type=int, default=5,
+        help="number of mails by thread")
+    parser.add_argument('--repeat', type=int, default=100)
+    parser.add_argument('--repeat-slow', type=int, default=5,
+        help="repeat of the benchmarks that modify data")
+    parser.add_argument('--batch', type=int, default=100,
+        help="number of records by call of the bulk benchmarks")
+    parser.add_argument('-k', dest='select', action='append',
+        help="run only the benchmarks containing the string")
+    parser.add_argument('-o', '--output', help="JSON file of the results")
+    parser.add_argument('--baseline', help="JSON file of previous results")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+        help="ratio of slowdown to the baseline allowed")
+    options = parser.parse_args()
+
+    random.seed(options.seed)
+    config.update_etc(options.config)
+    pool = Pool(options.database)
+    with Transaction().start(options.database, 0, readonly=True):
+        pool.init()
+
+    options.password = None
+    with Transaction().start(options.database, 0) as transaction:
+        if options.generate:
+            generate(options)
+        options.password = generate_user()
+        transaction.commit()
+
+    with Transaction().start(options.database, 0, readonly=True):
+        data = load_data()
+    if not data['works']:
+        parser.error("no synthetic data found")
+
+    results = {}
+    for name, func, mode in BENCHMARKS:
+        if options.select and not any(s in name for s in options.select):
+            continue
+        if mode:
+            extras = {}
+            while True:
+                # The restarted run picks the same records
+                random.seed(options.seed)
+                with Transaction().start(options.database, 0,
+                        readonly=mode == 'read', **extras) as transaction:
+                    try:
+                        durations = func(data, options)
+                    except TransactionError as e:
+                        # The records are locked when the transaction starts
+                        e.fix(extras)
+                        continue
+                    finally:
+                        transaction.rollback()
+                        transaction.tasks.clear()
+                break
+        else:
+            random.seed(options.seed)
+            durations = func(data, options)
+        if durations:
+            results[name] = summarize(durations)
+            report(name, results[name])
+
+    output = {
+        'backend': backend.name,
+        'date': datetime.datetime.now().isoformat(),
+        'parameters': {
+            k: v for k, v in vars(options).items()
+            if k not in {'config', 'database', 'password', 'output',
+                'baseline', 'select'}},
+        'results': results,
+        }
+    if options.output:
+        with open(options.output, 'w') as file:
+            json.dump(output, file, indent=2, sort_keys=True)
+    else:
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if options.baseline:
+        with open(options.baseline) as file:
+            baseline = json.load(file)['results']
+        if compare(results, baseline, options.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
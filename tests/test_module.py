@@ -1,14 +1,938 @@
-
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import datetime
+import gzip
+import hashlib
+import html
+from unittest.mock import patch
+
+import humanize
+from sql import Null
+
+from trytond.i18n import gettext
+from trytond.model.exceptions import AccessError, SQLConstraintError
+from trytond.modules.company.tests import (
+    CompanyTestMixin, create_company, create_employee, set_company)
+from trytond.modules.project_activity import instrumentation
+from trytond.modules.project_activity.work import (
+    archive_stub, conversation_parts, create_anchors)
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
+from trytond.url import URLAccessor
+
+
+def create_activity_type(name='E-mail'):
+    pool = Pool()
+    ActivityType = pool.get('activity.type')
+    activity_type, = ActivityType.create([{'name': name}])
+    return activity_type
+
+
+def create_party(name='Customer'):
+    pool = Pool()
+    Party = pool.get('party.party')
+    party, = Party.create([{'name': name}])
+    return party
+
+
+def create_work(company, name='Task', **values):
+    pool = Pool()
+    Work = pool.get('project.work')
+    work, = Work.create([{
+                'name': name,
+                'type': 'task',
+                'company': company.id,
+                **values,
+                }])
+    return work
+
+
+def create_activity(activity_type, employee, subject='Subject', **values):
+    pool = Pool()
+    Activity = pool.get('activity.activity')
+    dtstart = values.pop('dtstart', datetime.datetime(2026, 1, 5, 9))
+    activity, = Activity.create([{
+                'activity_type': activity_type.id,
+                'employee': employee.id,
+                'subject': subject,
+                'dtstart': dtstart,
+                'date': dtstart.date(),
+                'state': 'done',
+                **values,
+                }])
+    return activity
+
+
+def setup_configuration(company):
+    "Fill the activity values of the project configuration"
+    pool = Pool()
+    Configuration = pool.get('project.configuration')
+    Mailbox = pool.get('electronic.mail.mailbox')
+
+    employee = create_employee(company)
+    activity_type = create_activity_type()
+    mailbox, = Mailbox.create([{'name': 'Projects'}])
+    configuration = Configuration(1)
+    configuration.email_activity_type = activity_type
+    configuration.email_activity_employee = employee
+    configuration.email_activity_mailbox = mailbox
+    configuration.save()
+    return employee, activity_type, mailbox
+
+
+def create_mail(mailbox, work, subject='Re: Task', **values):
+    pool = Pool()
+    ElectronicMail = pool.get('electronic.mail')
+    mail, = ElectronicMail.create([{
+                'mailbox': mailbox.id,
+                'subject': subject,
+                'from_': 'customer@example.com',
+                'date': datetime.datetime(2026, 1, 5, 10),
+                'in_reply_to': '<%d@example.com>' % work.id,
+                'body_plain': "Answer",
+                'flag_seen': False,
+                **values,
+                }])
+    return mail
 
-from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+
+def render_conversation(activities, extranet=False):
+    "Render the conversation like before the names were read in bulk"
+    pool = Pool()
+    Attachment = pool.get('ir.attachment')
+
+    transaction = Transaction()
+    database = transaction.database.name
+
+    result = []
+    for activity in activities:
+        description_text = (activity.description or '').strip()
+        previous = []
+        body_mail = []
+        if len(description_text) > 0:
+            for line in description_text.replace('\\n', '\n').split('\n'):
+                if line.startswith('>'):
+                    previous.append(line)
+                else:
+                    body_mail += previous
+                    previous = []
+                    body_mail.append(line)
+
+        if extranet:
+            attachs_str = ''
+        else:
+            attachments = Attachment.search([
+                ('resource.id', '=', activity.id, 'activity.activity') ])
+            attachment_names = ['<a href="%s/%s/ir/attachment/%s">%s</a>' % (
+                URLAccessor.http_host(), database, x.id, x.name)
+                for x in attachments]
+            attachs_str = ('<div style="line-height: 2">' +
+                ' '.join(attachment_names) + '</div>')
+
+        body_str = '\n'.join(body_mail)
+        body_str = html.escape(body_str)
+        body_str = create_anchors(body_str)
+        body_str = '<br/>'.join(body_str.splitlines())
+
+        previous_str = '\n'.join(previous)
+        if previous_str.strip():
+            previous_str = html.escape(previous_str)
+            previous_str = create_anchors(previous_str)
+            previous_str = '<br/>'.join(previous_str.splitlines())
+            dots =  f'''<a href="javascript:toggle('{activity.id}');" class="dots">...</a>'''
+            dots += '<hr/>'
+            dots += f'<div id="{activity.id}" style="display:none; font-family: Sans-serif;"><br/>{previous_str}</div>'
+        else:
+            dots = ''
+
+        if extranet:
+            date_human = ''
+        else:
+            date_human = ', ' + humanize.naturaltime(activity.dtstart)
+
+        body = gettext('project_activity.msg_conversation',
+            type=activity.activity_type.name,
+            code=activity.code,
+            subject=activity.subject or '',
+            date=activity.date,
+            time=activity.time or '',
+            date_human=date_human,
+            contact=(activity.contacts and
+                     activity.contacts[0].party.name or ''),
+            employee=(activity.employee and activity.employee.party.name
+                or ''),
+            dots=dots,
+            activity=activity.state,
+            attachs_str=attachs_str,
+            body_str=body_str,
+        )
+        result.append(body)
+    if not result:
+        return None
+    return '''<!DOCTYPE html>
+            <html>
+            <head>
+            <meta charset="utf-8">
+            <style>
+            .dots {
+              background-color: lightgray;
+              margin-right: 5px;
+              padding: 3px;
+              border-radius: 6px;
+              white-space: nowrap;
+            }
+            </style>
+            <script>
+            function toggle(id) {
+                div = document.getElementById(id);
+                if (div.style.display) {
+                    div.style.display = '';
+                } else {
+                    div.style.display = "none";
+                }
+            }
+            </script>
+            </head>
+            <body>%s</body></html>
+            ''' % '<br/>'.join(result)
 
 
 class ProjectActivityTestCase(CompanyTestMixin, ModuleTestCase):
     'Test ProjectActivity module'
     module = 'project_activity'
+    extras = ['project_contact']
+
+    @with_transaction()
+    def test_resource_selection(self):
+        "Test resource selection follows project references"
+        pool = Pool()
+        Model = pool.get('ir.model')
+        ProjectReference = pool.get('project.reference')
+        Work = pool.get('project.work')
+
+        self.assertEqual(Work.get_resource(), [('', '')])
+
+        model, = Model.search([('name', '=', 'party.party')])
+        reference, = ProjectReference.create([{'model': model.id}])
+        self.assertEqual(
+            Work.get_resource(), [('', ''), ('party.party', model.string)])
+
+        ProjectReference.delete([reference])
+        self.assertEqual(Work.get_resource(), [('', '')])
+
+    @with_transaction()
+    def test_create_resource_many(self):
+        "Test create resource saves the tasks before linking the activities"
+        pool = Pool()
+        Activity = pool.get('activity.activity')
+        Work = pool.get('project.work')
+        CreateResource = pool.get('activity.create_resource', type='wizard')
+
+        company = create_company()
+        with set_company(company):
+            employee = create_employee(company)
+            activity_type = create_activity_type()
+            customer = create_party()
+            activities = [
+                create_activity(
+                    activity_type, employee, subject=s, party=customer.id)
+                for s in ['First', 'Second', 'First']]
+
+            calls = []
+            create_works, write_activities = Work.create, Activity.write
+
+            def create(vlist):
+                calls.append('create')
+                return create_works(vlist)
+
+            def write(*args):
+                calls.append('write')
+                return write_activities(*args)
+
+            session_id, _, _ = CreateResource.create()
+            with Transaction().set_context(
+                    active_model='activity.activity',
+                    active_ids=[a.id for a in activities]), \
+                    patch.object(Work, 'create', side_effect=create), \
+                    patch.object(Activity, 'write', side_effect=write):
+                create_resource = CreateResource(session_id)
+                create_resource.start.task = None
+                create_resource.start.party = None
+                create_resource.start.project = None
+                create_resource.do_open_task({'views': []})
+
+            self.assertEqual(calls, ['create', 'write'])
+            first, second, first_again = Activity.browse(
+                [a.id for a in activities])
+            self.assertIsInstance(first.resource, Work)
+            self.assertEqual(first.resource.name, 'First')
+            self.assertEqual(first.resource.party, customer)
+            self.assertEqual(first_again.resource, first.resource)
+            self.assertEqual(second.resource.name, 'Second')
+
+    @with_transaction()
+    def test_conversation_render(self):
+        "Test conversation is rendered as by activity"
+        pool = Pool()
+        Attachment = pool.get('ir.attachment')
+        Work = pool.get('project.work')
+
+        company = create_company()
+        with set_company(company):
+            employee = create_employee(company)
+            activity_type = create_activity_type()
+            work = create_work(company)
+            descriptions = [
+                "Hello <b>you</b>\nSee https://example.com/a?b=1&c=2\n"
+                "> quoted\n> more",
+                "Line\\nescaped\n> first\nanswer\n> second\n",
+                None,
+                ]
+            activities = [
+                create_activity(
+                    activity_type, employee, subject='Subject %d' % i,
+                    description=d, resource=str(work),
+                    dtstart=datetime.datetime(2026, 1, 5, 9 + i))
+                for i, d in enumerate(descriptions)]
+            Attachment.create([{
+                        'name': 'file.txt',
+                        'resource': str(activities[0]),
+                        'data': b'data',
+                        }])
+            activities = Work(work.id).activities
+
+            self.assertEqual(
+                Work.get_conversation_activities(activities),
+                render_conversation(activities))
+            self.assertEqual(
+                Work.get_conversation_activities(activities, extranet=True),
+                render_conversation(activities, extranet=True))
+
+    @with_transaction()
+    def test_open(self):
+        "Test open works"
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Work = pool.get('project.work')
+        WorkStatus = pool.get('project.work.status')
+
+        done = WorkStatus(ModelData.get_id('project', 'work_done_status'))
+        company = create_company()
+        with set_company(company):
+            open_work = create_work(company, 'Open')
+            done_work = create_work(company, 'Done', status=done.id)
+            domain = [('id', 'in', [open_work.id, done_work.id])]
+
+            self.assertTrue(open_work.open)
+            self.assertFalse(done_work.open)
+            self.assertEqual(
+                Work.search(domain + [('open', '=', True)]), [open_work])
+            self.assertEqual(
+                Work.search(domain + [('open', '=', False)]), [done_work])
+
+            WorkStatus.write([done], {'progress': 0.5})
+            self.assertEqual(
+                Work.search(domain + [('open', '=', True)],
+                    order=[('id', 'ASC')]),
+                [open_work, done_work])
+
+    @with_transaction()
+    def test_conversation_parts(self):
+        "Test stored conversation parts"
+        pool = Pool()
+        Activity = pool.get('activity.activity')
+        table = Activity.__table__()
+        cursor = Transaction().connection.cursor()
+        names = ['conversation_body', 'conversation_quoted']
+
+        def parts(activity):
+            values, = Activity.read([activity.id], names)
+            return values['conversation_body'], values['conversation_quoted']
+
+        company = create_company()
+        with set_company(company):
+            employee = create_employee(company)
+            activity_type = create_activity_type()
+            description = "Body https://example.com\n> quoted <text>"
+            activity = create_activity(
+                activity_type, employee, description=description)
+
+            self.assertEqual(parts(activity), conversation_parts(description))
+            self.assertEqual(parts(activity), (
+                    'Body <a href="https://example.com" target="_blank" '
+                    'rel="noopener">https://example.com</a>',
+                    '&gt; quoted &lt;text&gt;'))
+
+            Activity.write([activity], {'description': "New body"})
+            self.assertEqual(parts(activity), ('New body', ''))
+
+            cursor.execute(*table.update(
+                    [table.conversation_body, table.conversation_quoted],
+                    [Null, Null], where=table.id == activity.id))
+            Activity.fill_conversation_parts()
+            self.assertEqual(parts(activity), ('New body', ''))
+
+    @with_transaction()
+    def test_conversation_size(self):
+        "Test size-only read of conversation does not render it"
+        pool = Pool()
+        Work = pool.get('project.work')
+
+        company = create_company()
+        with set_company(company):
+            employee = create_employee(company)
+            activity_type = create_activity_type()
+            work = create_work(company)
+            empty_work = create_work(company, 'Empty')
+            for i in range(2):
+                create_activity(
+                    activity_type, employee, description="Body %d" % i,
+                    resource=str(work))
+
+            with Transaction().set_context(
+                    {'project.work.conversation': 'size'}), \
+                    patch.object(
+                        Work, 'get_conversation_activities') as render:
+                values = Work.read(
+                    [work.id, empty_work.id], ['conversation'])
+            render.assert_not_called()
+            sizes = {v['id']: v['conversation'] for v in values}
+            self.assertEqual(
+                sizes, Work.get_conversation_size([work, empty_work]))
+            self.assertGreater(sizes[work.id], 0)
+            self.assertEqual(sizes[empty_work.id], 0)
+
+            conversation = Work(work.id).conversation
+            self.assertIsInstance(conversation, bytes)
+            self.assertIn(b'Body 1', conversation)
+
+    @with_transaction()
+    def test_conversation_text_search(self):
+        "Test searching works by the text of their activities"
+        pool = Pool()
+        Activity = pool.get('activity.activity')
+        Work = pool.get('project.work')
+
+        def search(text):
+            return Work.search([
+                    ('id', 'in', [work.id, other.id]),
+                    ('conversation_text', 'ilike', text),
+                    ])
+
+        company = create_company()
+        with set_company(company):
+            employee = create_employee(company)
+            activity_type = create_activity_type()
+            work = create_work(company)
+            other = create_work(company, 'Other')
+            activity = create_activity(
+                activity_type, employee, subject="Delivery",
+                description="The banana shipment", resource=str(work))
+            create_activity(
+                activity_type, employee, description="Apples",
+                resource=str(other))
+
+            self.assertEqual(search('banana'), [work])
+            self.assertEqual(search('delivery'), [work])
+            self.assertEqual(search('apples'), [other])
+
+            Activity.write([activity], {'description': "The cherry crate"})
+            self.assertEqual(search('banana'), [])
+            self.assertEqual(search('cherry'), [work])
+
+    @with_transaction()
+    def test_conversation_cache(self):
+        "Test only the compressed conversation is cached"
+        pool = Pool()
+        Work = pool.get('project.work')
+        transaction = Transaction()
+
+        company = create_company()
+        with set_company(company):
+            employee = create_employee(company)
+            activity_type = create_activity_type()
+            work = create_work(company)
+            create_activity(
+                activity_type, employee, description="Body",
+                resource=str(work))
+
+            data = Work.get_conversation_content([work])[work.id]
+            self.assertIn(b'Body', data)
+            key = (work.id, transaction.user, transaction.language,
+                Work._get_conversation_keys([work]).get(work.id))
+            self.assertEqual(
+                gzip.decompress(Work._conversation_cache.get(key)), data)
+            self.assertEqual(
+                gzip.decompress(
+                    Work.get_conversation_content([work], 'gzip')[work.id]),
+                data)
+
+            with patch('trytond.modules.project_activity.work.'
+                    'CONVERSATION_CACHE_MAX_SIZE', 0):
+                Work._conversation_cache.clear()
+                Work.get_conversation_content([work])
+                self.assertIsNone(Work._conversation_cache.get(key))
+
+    @with_transaction()
+    def test_mail_thread_queue(self):
+        "Test unseen replies of the mailbox are queued to be threaded once"
+        pool = Pool()
+        Activity = pool.get('activity.activity')
+        ElectronicMail = pool.get('electronic.mail')
+        Mailbox = pool.get('electronic.mail.mailbox')
+        Queue = pool.get('ir.queue')
+        transaction = Transaction()
+
+        def queued():
+            return [t for t in Queue.browse(transaction.tasks)
+                if t.data['model'] == ElectronicMail.__name__
+                and t.data['method'] == 'create_activities']
+
+        company = create_company()
+        with set_company(company):
+            _, _, mailbox = setup_configuration(company)
+            other_mailbox, = Mailbox.create([{'name': 'Other'}])
+            work = create_work(company)
+            transaction.tasks.clear()
+
+            reply = create_mail(mailbox, work)
+            create_mail(other_mailbox, work)
+            create_mail(mailbox, work, flag_seen=True)
+            with transaction.set_context(_project_activity_thread=False):
+                create_mail(mailbox, work)
+
+            tasks = queued()
+            self.assertEqual(
+                [t.data['instances'] for t in tasks], [[reply.id]])
+            for task in tasks:
+                task.run()
+
+            activity, = Activity.search([('resource', '=', str(work))])
+            self.assertEqual(activity.subject, reply.subject)
+            self.assertTrue(ElectronicMail(reply.id).flag_seen)
+
+            ElectronicMail.create_activities([reply])
+            self.assertEqual(
+                Activity.search([('resource', '=', str(work))]), [activity])
+
+    @with_transaction()
+    def test_cron_get_mail_activity(self):
+        "Test mail cron threads the unseen mails missed by the queue"
+        pool = Pool()
+        Activity = pool.get('activity.activity')
+        Configuration = pool.get('project.configuration')
+        ElectronicMail = pool.get('electronic.mail')
+        table = ElectronicMail.__table__()
+        cursor = Transaction().connection.cursor()
+
+        company = create_company()
+        with set_company(company):
+            _, _, mailbox = setup_configuration(company)
+            work = create_work(company)
+            late = create_mail(mailbox, work, 'Re: late')
+            old = create_mail(mailbox, work, 'Re: old')
+            new = create_mail(mailbox, work, 'Re: new')
+            cursor.execute(*table.update(
+                    [table.create_date],
+                    [datetime.datetime.now() - datetime.timedelta(days=2)],
+                    where=table.id == old.id))
+
+            # The checkpoint is after the late mail as if it was committed
+            # after a run which threaded a mail with a higher id
+            configuration = Configuration(1)
+            configuration.email_activity_last_mail = old.id
+            configuration.save()
+
+            Activity.cron_get_mail_activity()
+
+            activities = Activity.search([('resource', '=', str(work))])
+            self.assertEqual(
+                sorted(a.subject for a in activities), ['Re: late', 'Re: new'])
+            late, old, new = ElectronicMail.browse([late.id, old.id, new.id])
+            self.assertTrue(late.flag_seen)
+            self.assertFalse(old.flag_seen)
+            self.assertTrue(new.flag_seen)
+            self.assertEqual(
+                Configuration(1).email_activity_last_mail, new.id)
+
+            Activity.cron_get_mail_activity()
+            self.assertEqual(
+                Activity.search_count([('resource', '=', str(work))]), 2)
+
+    @with_transaction()
+    def test_attachment_deduplicate(self):
+        "Test activity attachments with the same data share their file"
+        pool = Pool()
+        Activity = pool.get('activity.activity')
+        Attachment = pool.get('ir.attachment')
+
+        company = create_company()
+        with set_company(company):
+            employee = create_employee(company)
+            activity_type = create_activity_type()
+            first = create_activity(activity_type, employee)
+            second = create_activity(activity_type, employee)
+            party = create_party()
+
+            attachments = Attachment.create([{
+                        'name': 'logo.png',
+                        'resource': str(resource),
+                        'data': b'logo',
+                        } for resource in [first, second, party]])
+            on_first, on_second, on_party = attachments
+            digest = hashlib.sha256(b'logo').hexdigest()
+
+            self.assertEqual(on_first.data_hash, digest)
+            self.assertEqual(on_second.data_hash, digest)
+            self.assertIsNone(on_party.data_hash)
+            if Attachment.data.file_id:
+                self.assertEqual(on_first.file_id, on_second.file_id)
+            self.assertEqual(on_second.data, b'logo')
+            self.assertEqual(
+                [a.attachment_count for a in Activity.browse(
+                        [first.id, second.id])],
+                [1, 1])
+
+            Attachment.write([on_second], {'data': b'other'})
+            on_second, = Attachment.browse([on_second.id])
+            self.assertEqual(
+                on_second.data_hash, hashlib.sha256(b'other').hexdigest())
+            self.assertEqual(on_second.data, b'other')
+            self.assertEqual(Attachment(on_first.id).data, b'logo')
+
+            Attachment.delete([on_first])
+            self.assertEqual(Activity(first.id).attachment_count, 0)
+
+    @with_transaction()
+    def test_timeline(self):
+        "Test timeline pages the latest activities of each work"
+        pool = Pool()
+        Work = pool.get('project.work')
+
+        company = create_company()
+        with set_company(company):
+            employee = create_employee(company)
+            activity_type = create_activity_type()
+            work = create_work(company)
+            empty_work = create_work(company, 'Empty')
+            dtstart = datetime.datetime(2026, 1, 5, 9)
+            activities = [
+                create_activity(
+                    activity_type, employee, subject="Subject %d" % i,
+                    dtstart=dtstart + datetime.timedelta(hours=i // 2),
+                    resource=str(work))
+                for i in range(5)]
+            latest = sorted(
+                activities, key=lambda a: (a.dtstart, a.id), reverse=True)
+
+            timeline = Work.get_timeline([work, empty_work], limit=2)
+            values = timeline[work.id]
+            self.assertEqual(
+                values['last_action_date'], latest[0].dtstart.isoformat())
+            self.assertEqual(values['channel'], activity_type.id)
+            self.assertEqual(
+                [a['id'] for a in values['activities']],
+                [a.id for a in latest[:2]])
+            self.assertEqual(values['activities'][0], {
+                    'dtstart': latest[0].dtstart.isoformat(),
+                    'id': latest[0].id,
+                    'subject': latest[0].subject,
+                    'type': activity_type.id,
+                    })
+            self.assertEqual(
+                values['next'],
+                '%s,%s' % (latest[1].dtstart.isoformat(), latest[1].id))
+            self.assertEqual(timeline[empty_work.id], {
+                    'last_action_date': None,
+                    'channel': None,
+                    'contact_name': None,
+                    'activities': [],
+                    'next': None,
+                    })
+
+            ids = [a['id'] for a in values['activities']]
+            while values['next']:
+                before, id_ = values['next'].rsplit(',', 1)
+                before = (datetime.datetime.fromisoformat(before), int(id_))
+                values = Work.get_timeline(
+                    [work], limit=2, before=before)[work.id]
+                ids.extend(a['id'] for a in values['activities'])
+            self.assertEqual(ids, [a.id for a in latest])
+
+            keys = Work._get_conversation_keys([work, empty_work])
+            self.assertNotIn(empty_work.id, keys)
+            create_activity(activity_type, employee, resource=str(work))
+            self.assertNotEqual(
+                Work._get_conversation_keys([work])[work.id], keys[work.id])
+
+    @with_transaction()
+    def test_instrument(self):
+        "Test instrumented calls count only their own queries"
+        transaction = Transaction()
+        connection = transaction.connection
+
+        with patch.object(instrumentation, 'ENABLED', True):
+            @instrumentation.instrument('test.inner')
+            def inner(cls, ids):
+                cursor = Transaction().connection.cursor()
+                for _ in ids:
+                    cursor.execute('SELECT 1')
+
+            @instrumentation.instrument('test.outer')
+            def outer(cls, ids):
+                Transaction().connection.cursor().execute('SELECT 1')
+                inner(cls, ids)
+
+        outer(None, [1, 2])
+        transaction.connection.cursor().execute('SELECT 1')
+
+        self.assertIs(transaction.connection, connection)
+        metrics = instrumentation.metrics()
+        self.assertEqual(metrics['test.inner'], {
+                'calls': 1,
+                'records': 2,
+                'seconds': metrics['test.inner']['seconds'],
+                'queries': 2,
+                })
+        self.assertEqual(metrics['test.outer']['queries'], 3)
+        self.assertIn(
+            'project_activity_queries_total{name="test.outer"} 3',
+            instrumentation.format_metrics())
+
+    @with_transaction()
+    def test_archive_descriptions(self):
+        "Test archive and restore of the descriptions of closed works"
+        pool = Pool()
+        Activity = pool.get('activity.activity')
+        ModelData = pool.get('ir.model.data')
+        Work = pool.get('project.work')
+        table = Activity.__table__()
+        work_table = Work.__table__()
+        cursor = Transaction().connection.cursor()
+
+        def full_text(activity):
+            cursor.execute(*table.select(
+                    table.conversation_full_text,
+                    where=table.id == activity.id))
+            return cursor.fetchone()[0]
+
+        done = ModelData.get_id('project', 'work_done_status')
+        company = create_company()
+        with set_company(company):
+            employee = create_employee(company)
+            activity_type = create_activity_type()
+            work = create_work(company, status=done)
+            description = "Body " * 100
+            old = datetime.datetime(2025, 1, 5, 9)
+            activity = create_activity(
+                activity_type, employee, description=description,
+                dtstart=old, resource=str(work))
+            short = create_activity(
+                activity_type, employee, description="Short", dtstart=old,
+                resource=str(work))
+            cursor.execute(*work_table.update(
+                    [work_table.create_date, work_table.write_date],
+                    [old, old], where=work_table.id == work.id))
+            indexed = full_text(activity)
+            conversation = Work(work.id).conversation
+
+            Activity.archive_descriptions(delay=1)
+
+            activity, short = Activity.browse([activity.id, short.id])
+            self.assertEqual(activity.description, archive_stub(description))
+            self.assertTrue(activity.description_archive_id)
+            self.assertIsNone(short.description_archive_id)
+            self.assertEqual(
+                Activity.get_archived_descriptions([activity, short]),
+                {activity.id: description})
+            self.assertEqual(full_text(activity), indexed)
+            Work._conversation_cache.clear()
+            self.assertEqual(Work(work.id).conversation, conversation)
+
+            copy, = Activity.copy([activity], {'resource': None})
+            self.assertEqual(copy.description, description)
+            self.assertIsNone(copy.description_archive_id)
+            self.assertEqual(full_text(copy), indexed)
+            self.assertTrue(Activity(activity.id).description_archive_id)
+
+            with self.assertRaises(AccessError):
+                Activity.write([activity], {'description': "New"})
+            Activity.write([activity], {'subject': activity.subject})
+            self.assertEqual(
+                Activity(activity.id).description, archive_stub(description))
+
+            Activity.restore_description([activity])
+
+            activity = Activity(activity.id)
+            self.assertEqual(activity.description, description)
+            self.assertIsNone(activity.description_archive_id)
+            self.assertEqual(Activity.get_archived_descriptions([activity]), {})
+            Work._conversation_cache.clear()
+            self.assertEqual(Work(work.id).conversation, conversation)
+
+            Activity.write([activity], {'description': "New"})
+            self.assertEqual(Activity(activity.id).description, "New")
+
+    @with_transaction()
+    def test_stakeholder_action_lock(self):
+        "Test the works are locked once by the activity hooks"
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Work = pool.get('project.work')
+        WorkStatus = pool.get('project.work.status')
+
+        open_ = WorkStatus(ModelData.get_id('project', 'work_open_status'))
+        done = WorkStatus(ModelData.get_id('project', 'work_done_status'))
+        WorkStatus.write([open_], {'status_on_stakeholder_action': done.id})
+        company = create_company()
+        with set_company(company):
+            employee = create_employee(company)
+            activity_type = create_activity_type()
+            activity_type.update_status_on_stakeholder_action = True
+            activity_type.save()
+            work = create_work(company)
+
+            with patch.object(Work, 'lock') as lock:
+                create_activity(activity_type, employee, resource=str(work))
+
+            lock.assert_called_once_with([work])
+            self.assertEqual(Work(work.id).status, done)
+
+    @with_transaction()
+    def test_work_party_add_links(self):
+        "Test adding work parties ignores the existing links"
+        pool = Pool()
+        WorkParty = pool.get('project.work-party.party')
+
+        company = create_company()
+        with set_company(company):
+            work = create_work(company)
+            customer = create_party()
+            supplier = create_party('Supplier')
+            WorkParty.create([{'work': work.id, 'party': customer.id}])
+
+            WorkParty.add_links([
+                    (work.id, customer.id),
+                    (work.id, supplier.id),
+                    (work.id, supplier.id),
+                    ])
+
+            links = WorkParty.search([('work', '=', work.id)])
+            self.assertEqual(
+                sorted(link.party.id for link in links),
+                sorted([customer.id, supplier.id]))
+
+    @with_transaction()
+    def test_work_party_unique(self):
+        "Test a party is linked only once to a work"
+        pool = Pool()
+        WorkParty = pool.get('project.work-party.party')
+
+        company = create_company()
+        with set_company(company):
+            work = create_work(company)
+            party = create_party()
+
+            with self.assertRaises(SQLConstraintError):
+                WorkParty.create([
+                        {'work': work.id, 'party': party.id},
+                        {'work': work.id, 'party': party.id},
+                        ])
+
+    @with_transaction()
+    def test_work_party_register_duplicates(self):
+        "Test register removes the duplicated work parties"
+        pool = Pool()
+        WorkParty = pool.get('project.work-party.party')
+
+        company = create_company()
+        with set_company(company):
+            work = create_work(company)
+            party = create_party()
+            other = create_party('Other')
+            table_h = WorkParty.__table_handler__()
+            table_h.drop_constraint('work_party_unique')
+            first, _, other_link = WorkParty.create([
+                    {'work': work.id, 'party': party.id},
+                    {'work': work.id, 'party': party.id},
+                    {'work': work.id, 'party': other.id},
+                    ])
+
+            WorkParty.__register__('project_activity')
+
+            self.assertEqual(
+                WorkParty.search(
+                    [('work', '=', work.id)], order=[('id', 'ASC')]),
+                [first, other_link])
+            with self.assertRaises(SQLConstraintError):
+                WorkParty.create([{'work': work.id, 'party': party.id}])
+
+    @with_transaction()
+    def test_activity_changes(self):
+        "Test the cursor of the activity changes"
+        pool = Pool()
+        Change = pool.get('project.work.activity.change')
+        Work = pool.get('project.work')
+        table = Change.__table__()
+        cursor = Transaction().connection.cursor()
+
+        def changes(since=None, limit=2):
+            result = Work.get_activity_changes(since=since, limit=limit)
+            return [v['id'] for v in result['works']], result['cursor']
+
+        def set_transaction(change_ids, transaction_id):
+            cursor.execute(*table.update(
+                    [table.transaction_id], [transaction_id],
+                    where=table.id.in_(change_ids)))
+
+        company = create_company()
+        with set_company(company):
+            works = [create_work(company, 'Task %d' % i) for i in range(3)]
+            Change.log([w.id for w in works])
+            first, second, third = Change.search(
+                [('work', 'in', [w.id for w in works])],
+                order=[('id', 'ASC')])
+            # As if committed by a finished transaction
+            set_transaction([first.id, second.id, third.id], 0)
+            first, second, third = Change.browse(
+                [first.id, second.id, third.id])
+
+            work_ids, since = changes()
+            self.assertEqual(work_ids, [works[0].id, works[1].id])
+            self.assertEqual(since, '0,%s' % second.id)
+            work_ids, since = changes(since)
+            self.assertEqual(work_ids, [works[2].id])
+            self.assertEqual(changes(since), ([], since))
+            with patch('trytond.modules.project_activity.work.'
+                    'CHANGES_MAX_LIMIT', 1):
+                self.assertEqual(
+                    changes(limit=10), ([works[0].id], '0,%s' % first.id))
+
+            # The changes of the transactions which may still be running
+            # are held back
+            set_transaction([first.id], 5)
+            set_transaction([second.id], 7)
+            set_transaction([third.id], 6)
+            with patch.object(
+                    Change, 'get_finished_transaction_id', return_value=7):
+                work_ids, since = changes()
+                self.assertEqual(work_ids, [works[0].id, works[2].id])
+                self.assertEqual(since, '6,%s' % third.id)
+                self.assertEqual(changes(since), ([], since))
+            with patch.object(
+                    Change, 'get_finished_transaction_id', return_value=8):
+                self.assertEqual(
+                    changes(since), ([works[1].id], '7,%s' % second.id))
+
+            Change.log([works[0].id])
+            fourth, = Change.search(
+                [('id', 'not in', [first.id, second.id, third.id])])
+            set_transaction([fourth.id], 4)
+            Change.clean()
+            self.assertEqual(
+                Change.search([], order=[('id', 'ASC')]),
+                [first, second, third])
 
 
 del ModuleTestCase
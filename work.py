@@ -1,18 +1,38 @@
 # This file is part of project_activity module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import datetime
+import gzip
+import hashlib
 import html
 import humanize
+import json
 import re
 import mimetypes
+from collections import defaultdict
 from itertools import chain
 try:
     from http import HTTPStatus
 except ImportError:
     from http import client as HTTPStatus
-from trytond.model import ModelView, ModelSQL, fields
+try:
+    import brotli
+except ImportError:
+    brotli = None
+from sql import Cast, Literal, Null, Select, Values, Window
+from sql.aggregate import Count, Max, Min, Sum
+from sql.conditionals import Coalesce
+from sql.functions import (
+    CharLength, CurrentTimestamp, Function, RowNumber)
+from sql.operators import Concat
+from trytond import backend
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.model import Index, ModelView, ModelSQL, Unique, fields
+from trytond.model.exceptions import AccessError
 from trytond.pool import PoolMeta, Pool
 from trytond.pyson import Eval, Bool
+from trytond.rpc import RPC
 from trytond.i18n import gettext
 from trytond.wsgi import app
 from trytond.transaction import Transaction
@@ -20,17 +40,136 @@ from werkzeug.wrappers import Response
 from werkzeug.exceptions import abort
 from trytond.protocols.wrappers import with_pool, with_transaction
 from trytond.url import URLAccessor
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.wizard import (
     Button, StateAction, StateView, Wizard)
 from trytond.modules.electronic_mail_activity.activity import SendActivityMailMixin
 from trytond.exceptions import UserWarning
 
+from .instrumentation import (
+    ENABLED as INSTRUMENTATION, format_metrics, instrument)
+
 EMAIL_PATTERN = r"[a-z0-9\.\-+_]+@[a-z0-9\.\-+_]+\.[a-z]+"
+# in hours, the unseen mails created since are always checked by the cron
+MAIL_CATCHUP_WINDOW = config.getint(
+    'project_activity', 'mail_catchup_window', default=24)
+COMPRESS_MIN_SIZE = 1400
+COMPRESSIBLE_MIMETYPES = {
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'image/svg+xml',
+    }
+# in bytes, the larger compressed conversations are not cached
+CONVERSATION_CACHE_MAX_SIZE = config.getint(
+    'project_activity', 'conversation_cache_max_size', default=32 * 1024)
+TIMELINE_LIMIT = 10
+TIMELINE_MAX_LIMIT = 100
+# in days, 0 disables the archival of the descriptions
+ARCHIVE_DELAY = config.getint('project_activity', 'archive_delay', default=0)
+ARCHIVE_BATCH = config.getint(
+    'project_activity', 'archive_batch', default=1000)
+ARCHIVE_STUB_SIZE = 200
+CHANGES_LIMIT = 100
+CHANGES_MAX_LIMIT = 1000
+CHANGES_FIELDS = [
+    'last_action_date', 'channel', 'contact_name', 'conversation']
+CONVERSATION_HTML = '''<!DOCTYPE html>
+            <html>
+            <head>
+            <meta charset="utf-8">
+            <style>
+            .dots {
+              background-color: lightgray;
+              margin-right: 5px;
+              padding: 3px;
+              border-radius: 6px;
+              white-space: nowrap;
+            }
+            </style>
+            <script>
+            function toggle(id) {
+                div = document.getElementById(id);
+                if (div.style.display) {
+                    div.style.display = '';
+                } else {
+                    div.style.display = "none";
+                }
+            }
+            </script>
+            </head>
+            <body>%s</body></html>
+            '''
 
 def create_anchors(text):
     return re.sub(r"((http|https):\/\/\S*)", r'<a href="\1" target="_blank" rel="noopener">\1</a>', text)
 
 
+def conversation_parts(description):
+    "Return the HTML of the body and of the quoted history of description"
+    description_text = (description or '').strip()
+    previous = []
+    body_mail = []
+    if len(description_text) > 0:
+        for line in description_text.replace('\\n', '\n').split('\n'):
+            if line.startswith('>'):
+                previous.append(line)
+            else:
+                body_mail += previous
+                previous = []
+                body_mail.append(line)
+
+    body_str = '\n'.join(body_mail)
+    body_str = html.escape(body_str)
+    body_str = create_anchors(body_str)
+    body_str = '<br/>'.join(body_str.splitlines())
+
+    previous_str = '\n'.join(previous)
+    if previous_str.strip():
+        previous_str = html.escape(previous_str)
+        previous_str = create_anchors(previous_str)
+        previous_str = '<br/>'.join(previous_str.splitlines())
+    else:
+        previous_str = ''
+    return body_str, previous_str
+
+
+def archive_stub(description):
+    "Return the beginning of description kept in place of an archived one"
+    return description[:ARCHIVE_STUB_SIZE] + '\n[...]'
+
+
+def parse_changes_cursor(cursor):
+    "Return the (transaction id, id) pair of a cursor of the changes"
+    if not cursor:
+        return 0, 0
+    transaction_id, id_ = cursor.split(',')
+    return int(transaction_id), int(id_)
+
+
+def is_compressible(mimetype):
+    "Return if the data of mimetype is worth compressing"
+    if mimetype in COMPRESSIBLE_MIMETYPES:
+        return True
+    return mimetype.startswith('text/')
+
+
+def negotiate_encoding(request, size):
+    "Return the best content encoding accepted by request for size bytes"
+    if size < COMPRESS_MIN_SIZE:
+        return
+    encodings = ['gzip']
+    if brotli:
+        encodings.insert(0, 'br')
+    return request.accept_encodings.best_match(encodings)
+
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+
 @app.route('/<database_name>/ir/attachment/<int:record>',
     methods={'GET'})
 @app.auth_required
@@ -44,21 +183,175 @@ def attachment(request, pool, record):
         abort(HTTPStatus.NOT_FOUND)
 
     attachment = attachments[0]
-    mimetype, _ = mimetypes.guess_type(attachment.name)
+    mimetype, encoding = mimetypes.guess_type(attachment.name)
     if not mimetype:
         mimetype = 'application/octet-stream'
-    response = Response(attachment.data, mimetype=mimetype)
+    data = attachment.data
+    content_encoding = None
+    if not encoding and is_compressible(mimetype):
+        content_encoding = negotiate_encoding(request, len(data))
+        if content_encoding:
+            data = compress(data, content_encoding)
+    response = Response(data, mimetype=mimetype)
     response.headers.add(
             'Content-Disposition', 'attachment', filename=attachment.name)
-    response.headers.add('Content-Length', len(attachment.data))
+    response.headers.add('Content-Length', len(data))
+    if content_encoding:
+        response.headers.add('Content-Encoding', content_encoding)
+    response.vary.add('Accept-Encoding')
     return response
 
 
+@app.route('/<database_name>/project_activity/conversation/<int:record>',
+    methods={'GET'})
+@app.auth_required
+@with_pool
+@with_transaction(
+    user='request', context=dict(_check_access=True, fuzzy_translation=True))
+def conversation(request, pool, record):
+    Work = pool.get('project.work')
+    works = Work.search([('id', '=', record)], limit=1)
+    if not works:
+        abort(HTTPStatus.NOT_FOUND)
+
+    work, = works
+    # The rendered size is not known before rendering so accept any size
+    encoding = negotiate_encoding(request, COMPRESS_MIN_SIZE)
+    data = Work.get_conversation_content([work], encoding)[work.id]
+    response = Response(data, mimetype='text/html')
+    response.headers.add('Content-Length', len(data))
+    if encoding:
+        response.headers.add('Content-Encoding', encoding)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+@app.route('/<database_name>/project_activity/timeline', methods={'GET'})
+@app.auth_required
+@with_pool
+@with_transaction(user='request', context=dict(_check_access=True))
+def timeline(request, pool):
+    Work = pool.get('project.work')
+    transaction = Transaction()
+    try:
+        work_ids = [int(i) for v in request.args.getlist('works')
+            for i in v.split(',') if i]
+        limit = min(
+            int(request.args.get('limit', TIMELINE_LIMIT)),
+            TIMELINE_MAX_LIMIT)
+        before = request.args.get('before')
+        if before:
+            dtstart, id_ = before.rsplit(',', 1)
+            before = (datetime.datetime.fromisoformat(dtstart), int(id_))
+    except ValueError:
+        abort(HTTPStatus.BAD_REQUEST)
+    if limit < 1:
+        abort(HTTPStatus.BAD_REQUEST)
+
+    works = Work.search([('id', 'in', work_ids)], order=[('id', 'ASC')])
+    keys = Work._get_conversation_keys(works)
+    etag = hashlib.sha1(repr((
+                transaction.user, transaction.language, limit, before,
+                [(w.id, keys.get(w.id)) for w in works],
+                )).encode()).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=HTTPStatus.NOT_MODIFIED)
+    else:
+        data = json.dumps(
+            Work.get_timeline(works, limit=limit, before=before),
+            separators=(',', ':')).encode()
+        encoding = negotiate_encoding(request, len(data))
+        if encoding:
+            data = compress(data, encoding)
+        response = Response(data, mimetype='application/json')
+        response.headers.add('Content-Length', len(data))
+        if encoding:
+            response.headers.add('Content-Encoding', encoding)
+    response.set_etag(etag, weak=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+@app.route('/<database_name>/project_activity/changes', methods={'GET'})
+@app.auth_required
+@with_pool
+@with_transaction(user='request', context=dict(_check_access=True))
+def changes(request, pool):
+    Work = pool.get('project.work')
+    try:
+        since = request.args.get('since')
+        parse_changes_cursor(since)
+        limit = min(
+            int(request.args.get('limit', CHANGES_LIMIT)), CHANGES_MAX_LIMIT)
+    except ValueError:
+        abort(HTTPStatus.BAD_REQUEST)
+    if limit < 1:
+        abort(HTTPStatus.BAD_REQUEST)
+
+    result = Work.get_activity_changes(since=since, limit=limit)
+    for values in result['works']:
+        if values['last_action_date']:
+            values['last_action_date'] = (
+                values['last_action_date'].isoformat())
+        if values['conversation'] is not None:
+            values['conversation'] = values['conversation'].decode()
+    data = json.dumps(result, separators=(',', ':')).encode()
+    encoding = negotiate_encoding(request, len(data))
+    if encoding:
+        data = compress(data, encoding)
+    response = Response(data, mimetype='application/json')
+    response.headers.add('Content-Length', len(data))
+    if encoding:
+        response.headers.add('Content-Encoding', encoding)
+    response.cache_control.no_store = True
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+@app.route('/<database_name>/project_activity/metrics', methods={'GET'})
+@app.auth_required
+def metrics(request, database_name):
+    if not INSTRUMENTATION:
+        abort(HTTPStatus.NOT_FOUND)
+    return Response(format_metrics(), mimetype='text/plain; version=0.0.4')
+
+
 class ProjectReference(ModelSQL, ModelView):
     'Project Reference'
     __name__ = "project.reference"
 
     model = fields.Many2One('ir.model', 'Model', required=True)
+    _get_selection_cache = Cache(
+        'project.reference.get_selection', context=False)
+
+    @classmethod
+    def get_selection(cls):
+        language = Transaction().language
+        selection = cls._get_selection_cache.get(language)
+        if selection is not None:
+            return list(selection)
+        selection = [('', '')]
+        for _type in cls.search([]):
+            selection.append((_type.model.name, _type.model.string))
+        cls._get_selection_cache.set(language, selection)
+        return selection
+
+    @classmethod
+    def create(cls, vlist):
+        cls._get_selection_cache.clear()
+        return super().create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        cls._get_selection_cache.clear()
+
+    @classmethod
+    def delete(cls, references):
+        super().delete(references)
+        cls._get_selection_cache.clear()
 
 
 class Project(metaclass=PoolMeta):
@@ -79,18 +372,44 @@ class Project(metaclass=PoolMeta):
         filename='conversation_filename'), 'get_conversation')
     conversation_filename = fields.Function(fields.Char("File Name"),
         'get_conversation_filename')
+    conversation_text = fields.Function(fields.Text("Conversation Text"),
+        'get_conversation_text', searcher='search_conversation_text')
+    # The dates are humanized so the rendered conversations expire
+    _conversation_cache = Cache(
+        'project.work.conversation', duration=5 * 60, context=False)
+    open = fields.Function(fields.Boolean("Open"),
+        'get_open', searcher='search_open')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.__rpc__.update({
+                'get_activity_changes': RPC(),
+                })
+
+    @classmethod
+    def __setup_indexes__(cls):
+        super().__setup_indexes__()
+        table = cls.__table__()
+        # Open works of a party, see CreateResource
+        cls._sql_indexes.add(
+            Index(
+                table,
+                (table.party, Index.Range()),
+                (table.status, Index.Range()),
+                where=table.party != Null))
 
     @classmethod
     def copy(cls, project_works, default=None):
         pool = Pool()
         Configuration = pool.get('project.configuration')
-        config = Configuration(1)
+        config = Configuration.get_activity_values()
 
         if default is None:
             default = {}
         else:
             default = default.copy()
-        if config.synchronize_activity_time:
+        if config['synchronize_activity_time']:
             default.setdefault('activities', None)
         return super().copy(project_works, default=default)
 
@@ -118,66 +437,332 @@ class Project(metaclass=PoolMeta):
                 del result[name]
         return result
 
+    @classmethod
+    def get_activity_changes(cls, since=None, limit=CHANGES_LIMIT):
+        """Return the works whose activity fields changed after since
+
+        The changes are ordered by (transaction id, id) and since is the
+        cursor of the last change returned. The result contains the values
+        of the works and the cursor to use as since for the next call.
+        At most CHANGES_MAX_LIMIT changes are returned.
+        Only the changes of the transactions finished before all the running
+        ones are returned so none can be committed behind the cursor."""
+        pool = Pool()
+        Change = pool.get('project.work.activity.change')
+
+        def to_key(transaction_id, id_):
+            return '%s,%s' % (transaction_id, id_)
+
+        transaction_id, id_ = parse_changes_cursor(since)
+        limit = min(limit, CHANGES_MAX_LIMIT)
+        domain = ['OR',
+            ('transaction_id', '>', transaction_id),
+            [
+                ('transaction_id', '=', transaction_id),
+                ('id', '>', id_),
+                ],
+            ]
+        finished = Change.get_finished_transaction_id()
+        if finished is not None:
+            domain = [domain, ('transaction_id', '<', finished)]
+        with Transaction().set_context(_check_access=False):
+            changes = Change.search(domain,
+                order=[('transaction_id', 'ASC'), ('id', 'ASC')],
+                limit=limit)
+            work_ids = {c.work.id for c in changes}
+            if changes:
+                transaction_id = changes[-1].transaction_id
+                id_ = changes[-1].id
+        works = cls.search(
+            [('id', 'in', list(work_ids))], order=[('id', 'ASC')])
+        return {
+            'cursor': to_key(transaction_id, id_),
+            'works': cls.read([w.id for w in works], CHANGES_FIELDS),
+            }
+
+    def get_open(self, name):
+        return self.status.progress != 1
+
+    @classmethod
+    def search_open(cls, name, clause):
+        pool = Pool()
+        WorkStatus = pool.get('project.work.status')
+        _, operator, value = clause
+        status_ids = WorkStatus.get_open_ids()
+        if (operator, value) in {('=', True), ('!=', False)}:
+            return [('status', 'in', status_ids)]
+        return [('status', 'not in', status_ids)]
+
+    @classmethod
+    def get_timeline(cls, works, limit=TIMELINE_LIMIT, before=None):
+        """Return the activity summary and the latest activities of each work
+
+        The activities are ordered by descending (dtstart, id) and start
+        after the before key if any. The next key is set when there are
+        more activities to fetch.
+        """
+        pool = Pool()
+        Activity = pool.get('activity.activity')
+        cursor = Transaction().connection.cursor()
+        activity = Activity.__table__()
+        Contact = Activity.contacts.get_target()
+
+        def to_key(dtstart, id_):
+            return '%s,%s' % (dtstart.isoformat(), id_)
+
+        result = {}
+        last_dates, first_ids, page_ids = {}, {}, []
+        for sub_works in grouped_slice(works):
+            resources = [str(w) for w in sub_works]
+            where = activity.resource.in_(resources)
+
+            cursor.execute(*activity.select(
+                    activity.resource, Max(activity.dtstart),
+                    where=where,
+                    group_by=[activity.resource]))
+            last_dates.update(cursor)
+
+            first = activity.select(
+                activity.id, activity.resource,
+                RowNumber(window=Window([activity.resource],
+                        order_by=[activity.dtstart.asc, activity.id.desc])
+                    ).as_('rank'),
+                where=where)
+            cursor.execute(*first.select(
+                    first.resource, first.id,
+                    where=first.rank == 1))
+            first_ids.update(cursor)
+
+            if before:
+                dtstart, id_ = before
+                where &= ((activity.dtstart < dtstart)
+                    | ((activity.dtstart == dtstart) & (activity.id < id_)))
+            page = activity.select(
+                activity.id,
+                RowNumber(window=Window([activity.resource],
+                        order_by=[activity.dtstart.desc, activity.id.desc])
+                    ).as_('rank'),
+                where=where)
+            cursor.execute(*page.select(
+                    page.id, where=page.rank <= limit + 1))
+            page_ids.extend(i for i, in cursor)
+
+        # Apply the access rules of the activities
+        activities = Activity.search([
+                ('id', 'in', list(set(page_ids) | set(first_ids.values()))),
+                ], order=[('dtstart', 'DESC'), ('id', 'DESC')])
+        contact_ids = {a.contacts[0].id for a in activities
+            if a.id in first_ids.values() and a.contacts}
+        contact_names = {c.id: c.party.rec_name if c.party else None
+            for c in Contact.browse(list(contact_ids))}
+
+        for work in works:
+            last_action_date = last_dates.get(str(work))
+            if isinstance(last_action_date, str):
+                # SQLite does not convert aggregated values
+                last_action_date = datetime.datetime.fromisoformat(
+                    last_action_date)
+            result[work.id] = {
+                'last_action_date': (
+                    last_action_date.isoformat() if last_action_date
+                    else None),
+                'channel': None,
+                'contact_name': None,
+                'activities': [],
+                'next': None,
+                }
+        page_ids = set(page_ids)
+        for activity in activities:
+            work_id = activity.resource.id
+            values = result[work_id]
+            if activity.id == first_ids.get(str(activity.resource)):
+                if activity.activity_type:
+                    values['channel'] = activity.activity_type.id
+                if activity.contacts:
+                    values['contact_name'] = contact_names[
+                        activity.contacts[0].id]
+            if activity.id not in page_ids:
+                continue
+            if len(values['activities']) == limit:
+                values['next'] = to_key(*values['activities'][-1][:2])
+                continue
+            values['activities'].append((
+                    activity.dtstart, activity.id, activity.subject,
+                    activity.activity_type.id
+                    if activity.activity_type else None))
+        for values in result.values():
+            values['activities'] = [{
+                    'dtstart': dtstart.isoformat(),
+                    'id': id_,
+                    'subject': subject,
+                    'type': type_,
+                    } for dtstart, id_, subject, type_ in values['activities']]
+        return result
+
     @classmethod
     def get_resource(cls):
         ProjectReference = Pool().get('project.reference')
-        res = [('', '')]
-        for _type in ProjectReference.search([]):
-            res.append((_type.model.name, _type.model.string))
-        return res
+        return ProjectReference.get_selection()
+
+    @classmethod
+    def get_conversation(cls, works, name):
+        context = Transaction().context
+        if context.get('%s.%s' % (cls.__name__, name)) == 'size':
+            return cls.get_conversation_size(works)
+        return cls.get_conversation_content(works)
+
+    @classmethod
+    def get_conversation_content(cls, works, encoding=None):
+        "Return the conversation of each work encoded with encoding"
+        transaction = Transaction()
+        keys = cls._get_conversation_keys(works)
+        result = {}
+        for work in works:
+            key = (work.id, transaction.user, transaction.language,
+                keys.get(work.id))
+            # Only the gzip variant is cached and up to a size to bound the
+            # memory used by the workers
+            data = cls._conversation_cache.get(key)
+            if data is None:
+                summary = cls.get_conversation_activities(
+                    work.activities, collapse_attachments=True) or ''
+                # TODO supports str as value of Binary field so sao
+                # should also https://bugs.tryton.org/issue11534
+                data = compress(summary.encode(), 'gzip')
+                if len(data) <= CONVERSATION_CACHE_MAX_SIZE:
+                    cls._conversation_cache.set(key, data)
+            if encoding != 'gzip':
+                data = gzip.decompress(data)
+                if encoding:
+                    data = compress(data, encoding)
+            result[work.id] = data
+        return result
+
+    @classmethod
+    def _get_conversation_keys(cls, works):
+        "Return a value for each work that changes with its activities"
+        pool = Pool()
+        Activity = pool.get('activity.activity')
+        cursor = Transaction().connection.cursor()
+        activity = Activity.__table__()
+
+        result = {}
+        for sub_works in grouped_slice(works):
+            cursor.execute(*activity.select(
+                    activity.resource,
+                    Count(Literal('*')),
+                    Max(Coalesce(activity.write_date, activity.create_date)),
+                    Sum(Coalesce(activity.attachment_count, -1)),
+                    where=activity.resource.in_(
+                        [str(w) for w in sub_works]),
+                    group_by=[activity.resource]))
+            for resource, *key in cursor:
+                _, work_id = resource.split(',')
+                result[int(work_id)] = tuple(key)
+        return result
+
+    @classmethod
+    def get_conversation_size(cls, works):
+        "Return the estimated size of the conversations without rendering"
+        pool = Pool()
+        Activity = pool.get('activity.activity')
+        cursor = Transaction().connection.cursor()
+        activity = Activity.__table__()
+
+        template = gettext('project_activity.msg_conversation')
+        result = dict.fromkeys((w.id for w in works), 0)
+        for sub_works in grouped_slice(works):
+            cursor.execute(*activity.select(
+                    activity.resource,
+                    Count(Literal('*')),
+                    Sum(Coalesce(CharLength(activity.conversation_body), 0)
+                        + Coalesce(
+                            CharLength(activity.conversation_quoted), 0)
+                        + Coalesce(CharLength(activity.subject), 0)),
+                    where=activity.resource.in_(
+                        [str(w) for w in sub_works]),
+                    group_by=[activity.resource]))
+            for resource, count, length in cursor:
+                _, work_id = resource.split(',')
+                result[int(work_id)] = (len(CONVERSATION_HTML)
+                    + count * len(template) + (length or 0))
+        return result
 
-    def get_conversation(self, name):
-        summary = self.get_conversation_activities(self.activities) or ''
-        # TODO supports str as value of Binary field so sao should also
-        # https://bugs.tryton.org/issue11534
-        return summary.encode()
+    @classmethod
+    def get_conversation_text(cls, works, name):
+        # Only used to search on the activities
+        return dict.fromkeys((w.id for w in works), None)
+
+    @classmethod
+    def search_conversation_text(cls, name, clause):
+        _, operator, value = clause[:3]
+        return [('activities', 'where', [
+                    ('conversation_full_text', operator, value),
+                    ])]
 
     def get_conversation_filename(self, name):
         return 'conversation.html'
 
     @classmethod
-    def get_conversation_activities(cls, activities, extranet=False):
+    @instrument('project.work.get_conversation_activities')
+    def get_conversation_activities(cls, activities, extranet=False,
+            collapse_attachments=False):
         pool = Pool()
         Attachment = pool.get('ir.attachment')
 
         transaction = Transaction()
         database = transaction.database.name
 
+        names = cls._get_conversation_names(activities)
+        template = gettext('project_activity.msg_conversation')
+
+        if not extranet:
+            http_host = URLAccessor.http_host()
+            activity2attachments = defaultdict(list)
+            with_attachments = [a for a in activities
+                if a.attachment_count is None or a.attachment_count]
+            for sub_activities in grouped_slice(with_attachments):
+                for attachment in Attachment.search([
+                            ('resource', 'in',
+                                [str(a) for a in sub_activities]),
+                            ]):
+                    activity2attachments[attachment.resource.id].append(
+                        attachment)
+
+        # Archived descriptions are only read from the filestore when they
+        # are rendered
+        Activity = pool.get('activity.activity')
+        archived = Activity.get_archived_descriptions(activities)
+
         result = []
+        seen_hashes = set()
         for activity in activities:
-            description_text = (activity.description or '').strip()
-            previous = []
-            body_mail = []
-            if len(description_text) > 0:
-                for line in description_text.replace('\\n', '\n').split('\n'):
-                    if line.startswith('>'):
-                        previous.append(line)
-                    else:
-                        body_mail += previous
-                        previous = []
-                        body_mail.append(line)
+            if activity.id in archived:
+                body_str, previous_str = conversation_parts(
+                    archived[activity.id])
+            elif activity.conversation_body is not None:
+                body_str = activity.conversation_body
+                previous_str = activity.conversation_quoted or ''
+            else:
+                body_str, previous_str = conversation_parts(
+                    activity.description)
 
             if extranet:
                 attachs_str = ''
             else:
-                attachments = Attachment.search([
-                    ('resource.id', '=', activity.id, 'activity.activity') ])
+                attachments = activity2attachments[activity.id]
+                if collapse_attachments:
+                    # Only list the first copy of the same data
+                    attachments = [x for x in attachments
+                        if not x.data_hash or x.data_hash not in seen_hashes]
+                    seen_hashes.update(x.data_hash for x in attachments)
                 attachment_names = ['<a href="%s/%s/ir/attachment/%s">%s</a>' % (
-                    URLAccessor.http_host(), database, x.id, x.name)
+                    http_host, database, x.id, x.name)
                     for x in attachments]
                 attachs_str = ('<div style="line-height: 2">' +
                     ' '.join(attachment_names) + '</div>')
 
-            body_str = '\n'.join(body_mail)
-            body_str = html.escape(body_str)
-            body_str = create_anchors(body_str)
-            body_str = '<br/>'.join(body_str.splitlines())
-
-            previous_str = '\n'.join(previous)
-            if previous_str.strip():
-                previous_str = html.escape(previous_str)
-                previous_str = create_anchors(previous_str)
-                previous_str = '<br/>'.join(previous_str.splitlines())
+            if previous_str:
                 dots =  f'''<a href="javascript:toggle('{activity.id}');" class="dots">...</a>'''
                 dots += '<hr/>'
                 dots += f'<div id="{activity.id}" style="display:none; font-family: Sans-serif;"><br/>{previous_str}</div>'
@@ -189,51 +774,64 @@ class Project(metaclass=PoolMeta):
             else:
                 date_human = ', ' + humanize.naturaltime(activity.dtstart)
 
-            body = gettext('project_activity.msg_conversation',
-                type=activity.activity_type.name,
-                code=activity.code,
-                subject=activity.subject or '',
-                date=activity.date,
-                time=activity.time or '',
-                date_human=date_human,
-                contact=(activity.contacts and
-                         activity.contacts[0].party.name or ''),
-                employee=(activity.employee and activity.employee.party.name
-                    or ''),
-                dots=dots,
-                activity=activity.state,
-                attachs_str=attachs_str,
-                body_str=body_str,
-            )
+            type_name, contact, employee = names[activity.id]
+            body = template % {
+                'type': type_name,
+                'code': activity.code,
+                'subject': activity.subject or '',
+                'date': activity.date,
+                'time': activity.time or '',
+                'date_human': date_human,
+                'contact': contact,
+                'employee': employee,
+                'dots': dots,
+                'activity': activity.state,
+                'attachs_str': attachs_str,
+                'body_str': body_str,
+                }
             result.append(body)
         if not result:
             return None
-        return '''<!DOCTYPE html>
-            <html>
-            <head>
-            <meta charset="utf-8">
-            <style>
-            .dots {
-              background-color: lightgray;
-              margin-right: 5px;
-              padding: 3px;
-              border-radius: 6px;
-              white-space: nowrap;
-            }
-            </style>
-            <script>
-            function toggle(id) {
-                div = document.getElementById(id);
-                if (div.style.display) {
-                    div.style.display = '';
-                } else {
-                    div.style.display = "none";
-                }
-            }
-            </script>
-            </head>
-            <body>%s</body></html>
-            ''' % '<br/>'.join(result)
+        return CONVERSATION_HTML % '<br/>'.join(result)
+
+    @classmethod
+    def _get_conversation_names(cls, activities):
+        "Return the type, contact and employee names of each activity"
+        pool = Pool()
+        Activity = pool.get('activity.activity')
+        ActivityType = pool.get('activity.type')
+        Employee = pool.get('company.employee')
+        Contact = Activity.contacts.get_target()
+
+        type_ids, employee_ids, contact_ids = set(), set(), set()
+        for activity in activities:
+            if activity.activity_type:
+                type_ids.add(activity.activity_type.id)
+            if activity.employee:
+                employee_ids.add(activity.employee.id)
+            if activity.contacts:
+                contact_ids.add(activity.contacts[0].id)
+
+        def party_names(Model, ids):
+            return {r['id']: (r['party.'] or {}).get('name')
+                for r in Model.read(list(ids), ['party.name'])}
+
+        type_names = {t['id']: t['name']
+            for t in ActivityType.read(list(type_ids), ['name'])}
+        employee_names = party_names(Employee, employee_ids)
+        contact_names = party_names(Contact, contact_ids)
+
+        names = {}
+        for activity in activities:
+            names[activity.id] = (
+                type_names.get(
+                    activity.activity_type and activity.activity_type.id),
+                (activity.contacts
+                    and contact_names[activity.contacts[0].id] or ''),
+                (activity.employee
+                    and employee_names[activity.employee.id] or ''),
+                )
+        return names
 
 
 class Activity(metaclass=PoolMeta):
@@ -241,6 +839,216 @@ class Activity(metaclass=PoolMeta):
     tasks = fields.One2Many('project.work', 'resource', 'Tasks')
     timesheet_line = fields.One2One('activity.activity-timesheet.line',
         'activity', 'timesheet_line', "Timesheet Line")
+    conversation_body = fields.Text(
+        "Conversation Body", readonly=True, loading='lazy')
+    conversation_quoted = fields.Text(
+        "Conversation Quoted", readonly=True, loading='lazy')
+    attachment_count = fields.Integer("Attachment Count", readonly=True)
+    conversation_full_text = fields.FullText(
+        "Conversation Full Text", readonly=True, loading='lazy')
+    description_archive = fields.Binary(
+        "Archived Description", file_id='description_archive_id',
+        readonly=True)
+    description_archive_id = fields.Char(
+        "Archived Description ID", readonly=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table_h = cls.__table_handler__(module_name)
+        fill_conversation = not table_h.column_exist('conversation_body')
+        fill_attachment = not table_h.column_exist('attachment_count')
+        fill_full_text = not table_h.column_exist('conversation_full_text')
+
+        super().__register__(module_name)
+
+        if fill_conversation:
+            cls.fill_conversation_parts()
+        if fill_attachment:
+            cls.update_attachment_count()
+        if fill_full_text:
+            cls.update_full_text()
+
+        # The full text search of PostgreSQL needs a GIN index which can
+        # not be declared with Index
+        if backend.name == 'postgresql':
+            cursor.execute(
+                'CREATE INDEX IF NOT EXISTS '
+                '"activity_activity_conversation_full_text_gin" '
+                'ON "%s" USING GIN ("conversation_full_text")' % cls._table)
+
+    @classmethod
+    def default_attachment_count(cls):
+        return 0
+
+    @classmethod
+    def fill_conversation_parts(cls):
+        "Compute the stored conversation parts of the existing activities"
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        update = transaction.connection.cursor()
+        table = cls.__table__()
+
+        cursor.execute(*table.select(table.id, table.description,
+                where=table.conversation_body == Null))
+        while True:
+            rows = cursor.fetchmany(transaction.database.IN_MAX)
+            if not rows:
+                break
+            parts = Values([(id_, *conversation_parts(description))
+                    for id_, description in rows])
+            update.execute(*table.update(
+                    [table.conversation_body, table.conversation_quoted],
+                    [parts.column2, parts.column3],
+                    from_=[parts],
+                    where=table.id == parts.column1))
+
+    @classmethod
+    def update_attachment_count(cls, ids=None):
+        "Store the number of attachments of the activities"
+        pool = Pool()
+        Attachment = pool.get('ir.attachment')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        attachment = Attachment.__table__()
+
+        resource = Concat(cls.__name__ + ',', Cast(table.id, 'VARCHAR'))
+        count = attachment.select(Count(Literal('*')),
+            where=attachment.resource == resource)
+        if ids is None:
+            cursor.execute(*table.update([table.attachment_count], [count]))
+        else:
+            for sub_ids in grouped_slice(ids):
+                cursor.execute(*table.update(
+                        [table.attachment_count], [count],
+                        where=reduce_ids(table.id, sub_ids)))
+
+    @classmethod
+    def copy(cls, activities, default=None):
+        if default is None:
+            default = {}
+        else:
+            default = default.copy()
+        # Attachments may be copied by other modules
+        default.setdefault('attachment_count', None)
+        # The copies are not archived so they are indexed
+        archived = cls.get_archived_descriptions(activities)
+        default.setdefault('description',
+            lambda data: archived.get(data['id'], data['description']))
+        default.setdefault('description_archive', None)
+        default.setdefault('description_archive_id', None)
+        return super().copy(activities, default=default)
+
+    @classmethod
+    def update_full_text(cls, ids=None):
+        "Index the subject and description of the activities"
+        transaction = Transaction()
+        database = transaction.database
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        documents = [
+            Coalesce(table.subject, ''), Coalesce(table.description, '')]
+        if database.has_search_full_text():
+            value = database.format_full_text(
+                *documents, language=transaction.language)
+        else:
+            value = Concat(Concat(documents[0], '\n'), documents[1])
+        # The stub of archived descriptions must not replace their index
+        where = table.description_archive_id == Null
+        if ids is None:
+            cursor.execute(*table.update(
+                    [table.conversation_full_text], [value], where=where))
+        else:
+            for sub_ids in grouped_slice(ids):
+                cursor.execute(*table.update(
+                        [table.conversation_full_text], [value],
+                        where=where & reduce_ids(table.id, sub_ids)))
+
+    @classmethod
+    def _conversation_values(cls, values):
+        if 'description' in values:
+            values = values.copy()
+            body, quoted = conversation_parts(values['description'])
+            values['conversation_body'] = body
+            values['conversation_quoted'] = quoted
+        return values
+
+    @classmethod
+    def archive_descriptions(cls, delay=None, limit=None):
+        """Move the descriptions of the activities of long-closed works to
+        the filestore
+
+        Only limit activities are archived by call. The description is
+        replaced by a stub and the archive is compressed."""
+        pool = Pool()
+        Work = pool.get('project.work')
+        WorkStatus = pool.get('project.work.status')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        recent = cls.__table__()
+        work = Work.__table__()
+
+        if delay is None:
+            delay = ARCHIVE_DELAY
+        if limit is None:
+            limit = ARCHIVE_BATCH
+        if not delay:
+            return
+        date = datetime.datetime.now() - datetime.timedelta(days=delay)
+
+        is_work = table.resource.like(Work.__name__ + ',%')
+        where = (is_work
+            & (table.description_archive_id == Null)
+            & (CharLength(table.description) > ARCHIVE_STUB_SIZE)
+            & (Coalesce(work.write_date, work.create_date) < date)
+            & ~table.resource.in_(recent.select(recent.resource,
+                    where=recent.resource.like(Work.__name__ + ',%')
+                    & (recent.dtstart >= date))))
+        open_ids = WorkStatus.get_open_ids()
+        if open_ids:
+            where &= ~work.status.in_(open_ids)
+        cursor.execute(*table.join(work,
+                condition=cls.resource.sql_id(table.resource, Work)
+                == work.id
+                ).select(table.id, table.description,
+                where=where, order_by=[table.id.asc], limit=limit))
+        for id_, description in cursor.fetchall():
+            cls.description_archive.set(cls, 'description_archive', [id_],
+                gzip.compress(description.encode()))
+            cursor.execute(*table.update(
+                    [table.description, table.conversation_body,
+                        table.conversation_quoted],
+                    [archive_stub(description), Null, Null],
+                    where=table.id == id_))
+
+    @classmethod
+    @ModelView.button
+    def restore_description(cls, activities):
+        "Put back the archived descriptions of the activities"
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        archived = cls.get_archived_descriptions(activities)
+        cls.description_archive.set(
+            cls, 'description_archive', list(archived), None)
+        for id_, description in archived.items():
+            body, quoted = conversation_parts(description)
+            cursor.execute(*table.update(
+                    [table.description, table.conversation_body,
+                        table.conversation_quoted],
+                    [description, body, quoted],
+                    where=table.id == id_))
+
+    @classmethod
+    def get_archived_descriptions(cls, activities):
+        "Return the archived description of the activities by id"
+        ids = [a.id for a in activities if a.description_archive_id]
+        return {r['id']: gzip.decompress(r['description_archive']).decode()
+            for r in cls.read(ids, ['description_archive'])
+            if r['description_archive']}
 
     @classmethod
     def default_party(cls):
@@ -250,7 +1058,42 @@ class Activity(metaclass=PoolMeta):
         return super(Activity, cls).default_party()
 
     @classmethod
+    @instrument('activity.activity.cron_get_mail_activity')
     def cron_get_mail_activity(cls):
+        pool = Pool()
+        ElectronicMail = pool.get('electronic.mail')
+        Configuration = pool.get('project.configuration')
+
+        mailbox = Configuration.get_activity_values()['email_activity_mailbox']
+        if not mailbox:
+            return
+
+        # New mails are threaded when they are created, see
+        # ElectronicMail.create, so only the ones missed since the last run
+        # are searched. The recent ones are searched again because mails
+        # with a lower id may be committed after the last run.
+        config = Configuration(1)
+        last_mail = config.email_activity_last_mail or 0
+        date = datetime.datetime.now() - datetime.timedelta(
+            hours=MAIL_CATCHUP_WINDOW)
+        mails = ElectronicMail.search([
+                ['OR',
+                    ('id', '>', last_mail),
+                    ('create_date', '>=', date),
+                    ],
+                ('in_reply_to', '!=', None),
+                ('flag_seen', '=', False),
+                ('mailbox', '=', mailbox)
+                ], order=[('id', 'ASC')])
+        cls.create_mail_activities(mails)
+        if mails:
+            config.email_activity_last_mail = max(mails[-1].id, last_mail)
+            config.save()
+
+    @classmethod
+    @instrument('activity.activity.create_mail_activities')
+    def create_mail_activities(cls, mails):
+        "Create the activities of the mails replying to works"
         pool = Pool()
         ElectronicMail = pool.get('electronic.mail')
         ProjectWork = pool.get('project.work')
@@ -268,18 +1111,16 @@ class Activity(metaclass=PoolMeta):
             except ValueError:
                 return
 
-        configuration = Configuration(1)
-        default_employee = configuration.email_activity_employee
-        default_activity_type = configuration.email_activity_type
-        mailbox = configuration.email_activity_mailbox
-        if not mailbox:
-            return
+        configuration = Configuration.get_activity_values()
+        default_employee = configuration['email_activity_employee']
+        default_activity_type = configuration['email_activity_type']
 
-        mails = ElectronicMail.search([
-                ('in_reply_to', '!=', None),
-                ('flag_seen', '=', False),
-                ('mailbox', '=', mailbox.id)
-                ])
+        if not mails:
+            return
+        # The cron and the queue may thread the same mail
+        ElectronicMail.lock(mails)
+        mails = [m for m in ElectronicMail.browse([m.id for m in mails])
+            if not m.flag_seen]
         new_args = []
         for mail in mails:
             work_ids = []
@@ -314,7 +1155,7 @@ class Activity(metaclass=PoolMeta):
                                         from_email[0])
                                     ], limit=1)
                             if employees:
-                                employee = employees[0]
+                                employee = employees[0].id
 
                     activities = {
                         'activities': [
@@ -341,7 +1182,11 @@ class Activity(metaclass=PoolMeta):
 
     @classmethod
     def create(cls, vlist):
+        vlist = [cls._conversation_values(v) for v in vlist]
         res = super().create(vlist)
+        cls.update_full_text([a.id for a in res])
+        cls.log_work_changes(res)
+        cls.lock_works(res)
         cls.sync_project_contacts(res)
         cls.update_status_on_stakeholder_action(res)
         cls.sync_timesheetline(res)
@@ -349,53 +1194,117 @@ class Activity(metaclass=PoolMeta):
 
     @classmethod
     def write(cls, *args):
+        pool = Pool()
+        Change = pool.get('project.work.activity.change')
+        args = list(args)
+        actions = iter(args)
+        for activities, values in zip(actions, actions):
+            if 'description' in values:
+                # The description is only a stub of the archived one
+                for activity in activities:
+                    if activity.description_archive_id:
+                        raise AccessError(gettext(
+                                'project_activity'
+                                '.msg_activity_description_archived',
+                                activity=activity.rec_name))
+        args[1::2] = [cls._conversation_values(v) for v in args[1::2]]
+        # The previous works must also be logged when resource changes
+        work_ids = cls._work_ids(list(chain(*args[::2])))
         super().write(*args)
+        actions = iter(args)
+        to_index = []
+        for activities, values in zip(actions, actions):
+            if values.keys() & {'subject', 'description'}:
+                to_index.extend(a.id for a in activities)
+        cls.update_full_text(to_index)
+        Change.log(work_ids | cls._work_ids(
+                cls.browse([a.id for a in chain(*args[::2])])))
+        cls.lock_works(list(chain(*args[::2])))
         cls.sync_project_contacts(list(chain(*args[::2])))
         cls.update_status_on_stakeholder_action(list(chain(*args[::2])))
         cls.sync_timesheetline(list(chain(*args[::2])))
 
     @classmethod
+    def _work_ids(cls, activities):
+        pool = Pool()
+        Work = pool.get('project.work')
+        return {a.resource.id for a in activities
+            if isinstance(a.resource, Work)}
+
+    @classmethod
+    def log_work_changes(cls, activities):
+        "Record that the activity fields of the works of activities changed"
+        pool = Pool()
+        Change = pool.get('project.work.activity.change')
+        Change.log(cls._work_ids(activities))
+
+    @classmethod
+    def _works_to_lock(cls, activities):
+        "Return the ids of the works updated by the hooks of activities"
+        pool = Pool()
+        Work = pool.get('project.work')
+        work_ids = set()
+        for activity in activities:
+            if not isinstance(activity.resource, Work):
+                continue
+            if (activity.contacts
+                    or (activity.activity_type and activity.activity_type
+                        .update_status_on_stakeholder_action)):
+                work_ids.add(activity.resource.id)
+        return work_ids
+
+    @classmethod
+    def lock_works(cls, activities):
+        """Lock all the works updated by the hooks of activities
+
+        They are locked at once before running the hooks so the locks are
+        always taken in the same order."""
+        pool = Pool()
+        Work = pool.get('project.work')
+        work_ids = cls._works_to_lock(activities)
+        if work_ids:
+            Work.lock(Work.browse(sorted(work_ids)))
+
+    @classmethod
+    @instrument('activity.activity.update_status_on_stakeholder_action')
     def update_status_on_stakeholder_action(cls, activities):
         pool = Pool()
         Work = pool.get('project.work')
+        work_ids = {a.resource.id for a in activities
+            if isinstance(a.resource, Work)
+            and a.activity_type
+            and a.activity_type.update_status_on_stakeholder_action}
+        if not work_ids:
+            return
         to_save = []
-        for activity in activities:
-            if activity.activity_type or activity.resource:
-                if (isinstance(activity.resource, Work)
-                        and activity.activity_type.update_status_on_stakeholder_action):
-                    work = activity.resource
-                    new_status = activity.resource.status.status_on_stakeholder_action
-                    if new_status:
-                        work.status = new_status
-                        to_save.append(work)
+        # The works are locked by lock_works
+        for work in Work.browse(sorted(work_ids)):
+            new_status = work.status.status_on_stakeholder_action
+            if new_status and new_status != work.status:
+                work.status = new_status
+                to_save.append(work)
         Work.save(to_save)
 
     @classmethod
+    @instrument('activity.activity.sync_project_contacts')
     def sync_project_contacts(cls, activities):
         pool = Pool()
         Work = pool.get('project.work')
-        WorkParty = pool.get('project.work-party.party')
-        to_save = []
+        try:
+            WorkParty = pool.get('project.work-party.party')
+        except KeyError:
+            # project_contact is not activated
+            return
+        links = set()
         for activity in activities:
             if isinstance(activity.resource, Work):
-                resource = activity.resource
                 for contact in activity.contacts:
-                    if contact.party not in [c.party for c in resource.contacts]:
-                        work_contact = WorkParty.search([
-                            ('work', '=', resource.id),
-                            ('party', '=', contact.party.id),
-                            ], limit=1)
-                        if not work_contact:
-                            work_contact = WorkParty()
-                            work_contact.work = resource
-                            work_contact.party = contact.party
-                        else:
-                            work_contact = work_contact[0]
-                        activity.resource.contacts += (work_contact,)
-                to_save.append(resource)
-        Work.save(to_save)
+                    if contact.party:
+                        links.add((activity.resource.id, contact.party.id))
+        WorkParty.add_links(links)
 
     @classmethod
+    @instrument('activity.activity.sync_timesheetline')
     def sync_timesheetline(cls, activities):
         pool = Pool()
         Work = pool.get('project.work')
@@ -404,8 +1313,8 @@ class Activity(metaclass=PoolMeta):
         Configuration = pool.get('project.configuration')
 
         with Transaction().set_context(_check_access=False):
-            config = Configuration(1)
-            if not config.synchronize_activity_time:
+            config = Configuration.get_activity_values()
+            if not config['synchronize_activity_time']:
                 return
 
             to_save = []
@@ -478,6 +1387,7 @@ class Activity(metaclass=PoolMeta):
                     'project_activity.msg_delete_act_and_tl',
                     activity=activity))
             TimesheetLine.delete(to_delete)
+        cls.log_work_changes(activities)
         super().delete(activities)
 
     @classmethod
@@ -487,8 +1397,30 @@ class Activity(metaclass=PoolMeta):
                 'create_resource': {
                     'icon': 'tryton-ok',
                     'invisible': ~Bool(Eval('party')) | Bool(Eval('resource'))
-                }
+                },
+                'restore_description': {
+                    'icon': 'tryton-undo',
+                    'invisible': ~Bool(Eval('description_archive_id')),
+                    'depends': ['description_archive_id'],
+                    },
                 })
+        readonly = Bool(Eval('description_archive_id'))
+        if cls.description.states.get('readonly'):
+            readonly |= cls.description.states['readonly']
+        cls.description.states['readonly'] = readonly
+
+    @classmethod
+    def __setup_indexes__(cls):
+        super().__setup_indexes__()
+        table = cls.__table__()
+        # Latest activity of a work, see ProjectActivityEmail.get_in_reply_to
+        cls._sql_indexes.add(
+            Index(
+                table,
+                (table.resource, Index.Equality()),
+                (table.dtstart, Index.Range()),
+                (table.id, Index.Range()),
+                where=table.resource != Null))
 
     @classmethod
     @ModelView.button_action('project_activity.act_create_resource_wizard')
@@ -507,50 +1439,124 @@ class CreateResource(Wizard):
     open_task = StateAction('project.act_task_form')
 
     def default_start(self, fields):
-        pool = Pool()
-        Work = pool.get('project.work')
-        projects = Work.search([
-            ('type', '=', 'project'),
-            ('party.id', '=', self.record.party.id),
-            ['OR',
-                [
-                    ('status.progress', '!=', '1'),
-                ], [
-                    ('status.progress', '=', None),
-                ],
-            ],
-            ])
+        parties = {a.party for a in self.records}
+        party = parties.pop() if len(parties) == 1 else None
+        projects = self.get_projects([party]) if party else {}
         default = {}
-        default['activity'] = self.record.id
-        default['party'] = self.record.party.id
-        default['project'] = projects[0].id if projects else None
+        default['activity'] = self.record.id if len(self.records) == 1 else None
+        default['party'] = party.id if party else None
+        default['project'] = (
+            projects[party].id if party in projects else None)
         return default
 
-    def get_task(self):
+    @classmethod
+    def get_projects(cls, parties):
+        "Return the first open project of each party"
+        pool = Pool()
+        Work = pool.get('project.work')
+        if len(parties) == 1:
+            party, = parties
+            projects = Work.search([
+                ('type', '=', 'project'),
+                ('party', '=', party.id),
+                ('open', '=', True),
+                ], order=[('id', 'ASC')], limit=1)
+        else:
+            projects = Work.search([
+                ('type', '=', 'project'),
+                ('party', 'in', [p.id for p in parties]),
+                ('open', '=', True),
+                ], order=[('id', 'ASC')])
+        result = {}
+        for project in projects:
+            result.setdefault(project.party, project)
+        return result
+
+    def get_task(self, activity=None, project=None):
         pool = Pool()
         Work = pool.get('project.work')
         task = Work()
 
-        task.parent = self.start.project
+        if activity is None:
+            activity = self.record
+            project = self.start.project
+        task.parent = project
         task.on_change_parent()
-        task.name = self.record.subject
-        task.party = self.record.party
-        task.comment = self.record.description
+        task.name = activity.subject
+        task.party = activity.party
+        task.comment = activity.description
         # We do not fill 'activities' field here
         # because it will cause a write() on activity.activity before
         # timesheet.work is created by project.work and this would cause
         # sync_timesheet_line() to be called before timesheet works are created
         return task
 
+    def get_tasks(self, activities):
+        "Return the task of each activity matching or creating them"
+        pool = Pool()
+        Work = pool.get('project.work')
+
+        parties = {a.party for a in activities}
+        projects = self.get_projects(parties)
+        if self.start.party and self.start.project:
+            projects[self.start.party] = self.start.project
+
+        # Activities of a party with the same subject share the open task
+        # with that name if any
+        keys = {(a.party, a.subject) for a in activities}
+        tasks = {}
+        for task in Work.search([
+                    ('type', '=', 'task'),
+                    ('party', 'in', [p.id for p in parties]),
+                    ('name', 'in', list({s for _, s in keys if s})),
+                    ('open', '=', True),
+                    ], order=[('id', 'ASC')]):
+            tasks.setdefault((task.party, task.name), task)
+        to_create = []
+        for activity in activities:
+            key = (activity.party, activity.subject)
+            if key not in tasks:
+                tasks[key] = self.get_task(
+                    activity, projects.get(activity.party))
+                to_create.append(tasks[key])
+        Work.save(to_create)
+        return {a: tasks[(a.party, a.subject)] for a in activities}
+
     def do_open_task(self, action):
-        if not self.start.task:
-            task = self.get_task()
-            task.save()
+        pool = Pool()
+        Activity = pool.get('activity.activity')
+
+        if len(self.records) == 1:
+            if not self.start.task:
+                task = self.get_task()
+                task.save()
+            else:
+                task = self.start.task
+            self.record.resource = task
+            self.record.save()
+            tasks = [task]
         else:
-            task = self.start.task
-        self.record.resource = task
-        self.record.save()
-        data = {'res_id': [task.id], 'views': action['views'].reverse()}
+            activities = [a for a in self.records
+                if a.party and not a.resource]
+            if self.start.task:
+                activity2task = dict.fromkeys(activities, self.start.task)
+            else:
+                activity2task = self.get_tasks(activities)
+            # Tasks are saved before the activities are linked to get
+            # their timesheet works created first
+            task2activities = {}
+            for activity, task in activity2task.items():
+                task2activities.setdefault(task, []).append(activity)
+            args = []
+            for task, task_activities in task2activities.items():
+                args.extend((task_activities, {'resource': str(task)}))
+            if args:
+                Activity.write(*args)
+            tasks = list(task2activities)
+        data = {
+            'res_id': [t.id for t in tasks],
+            'views': action['views'].reverse(),
+            }
         return action, data
 
 
@@ -563,35 +1569,198 @@ class CreateResourceStart(ModelView):
         domain=[
             ('type', '=', 'project'),
             ('party', '=', Eval('party', -1)),
-            ['OR',
-                [
-                    ('status.progress', '!=', '1'),
-                ], [
-                    ('status.progress', '=', None),
-                ],
-                ],
-                ], depends = ['party'])
+            ('open', '=', True),
+            ], depends=['party'])
     task = fields.Many2One('project.work', "Task",
         domain=[
             ('type', '=', 'task'),
             ('party', '=', Eval('party', -1)),
-            ['OR',
-                [
-                    ('status.progress', '!=', '1'),
-                ], [
-                    ('status.progress', '=', None),
-                ],
-                ],
-                ], depends = ['party'])
+            ('open', '=', True),
+            ], depends=['party'])
     tasks = fields.One2Many('project.work', None, "Tasks", readonly=True)
 
 
+class CurrentTransactionId(Function):
+    __slots__ = ()
+    _function = 'PG_CURRENT_XACT_ID'
+
+
+class CurrentSnapshot(Function):
+    __slots__ = ()
+    _function = 'PG_CURRENT_SNAPSHOT'
+
+
+class SnapshotXmin(Function):
+    __slots__ = ()
+    _function = 'PG_SNAPSHOT_XMIN'
+
+
+class BigInteger(fields.Integer):
+    "Integer stored on 64 bits"
+    _sql_type = 'BIGINT'
+
+
+class WorkActivityChange(ModelSQL):
+    "Project Work Activity Change"
+    __name__ = 'project.work.activity.change'
+    work = fields.Many2One(
+        'project.work', "Work", required=True, ondelete='CASCADE')
+    transaction_id = BigInteger("Transaction ID")
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.work, Index.Equality())),
+                Index(t,
+                    (t.transaction_id, Index.Range()),
+                    (t.id, Index.Range())),
+                })
+
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().connection.cursor()
+        table_h = cls.__table_handler__(module_name)
+        table = cls.__table__()
+        fill_transaction = not table_h.column_exist('transaction_id')
+
+        super().__register__(module_name)
+
+        # The existing changes are committed
+        if fill_transaction:
+            cursor.execute(*table.update([table.transaction_id], [0]))
+
+    @classmethod
+    def log(cls, work_ids):
+        """Record a change of the works
+
+        The log is only appended to so concurrent transactions do not
+        conflict on it."""
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        if backend.name == 'postgresql':
+            transaction_id = Cast(
+                Cast(CurrentTransactionId(), 'TEXT'), 'BIGINT')
+        else:
+            # SQLite serializes the writing transactions so the changes are
+            # committed in id order
+            transaction_id = 0
+        for sub_ids in grouped_slice(sorted(set(work_ids))):
+            cursor.execute(*table.insert(
+                    [table.work, table.transaction_id,
+                        table.create_uid, table.create_date],
+                    [[w, transaction_id, transaction.user, CurrentTimestamp()]
+                        for w in sub_ids]))
+
+    @classmethod
+    def get_finished_transaction_id(cls):
+        """Return the transaction id below which all the transactions are
+        finished or None if all the committed changes are final"""
+        if backend.name != 'postgresql':
+            return None
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*Select([Cast(
+                        Cast(SnapshotXmin(CurrentSnapshot()), 'TEXT'),
+                        'BIGINT')]))
+        transaction_id, = cursor.fetchone()
+        return transaction_id
+
+    @classmethod
+    def clean(cls):
+        "Remove the changes followed by a newer change of the same work"
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        change = cls.__table__()
+        newer = cls.__table__()
+
+        cursor.execute(*table.delete(
+                where=table.id.in_(change.join(newer,
+                        condition=(newer.work == change.work)
+                        & ((newer.transaction_id > change.transaction_id)
+                            | ((newer.transaction_id == change.transaction_id)
+                                & (newer.id > change.id)))
+                        ).select(change.id))))
+
+
+class WorkParty(metaclass=PoolMeta):
+    __name__ = 'project.work-party.party'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('work_party_unique', Unique(t, t.work, t.party),
+                'project_activity.msg_work_party_unique'),
+            ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        first = cls.__table__()
+
+        if backend.TableHandler.table_exist(cls._table):
+            # Remove the duplicated links before adding the constraint
+            cursor.execute(*table.delete(
+                    where=~table.id.in_(first.select(Min(first.id),
+                            group_by=[first.work, first.party]))))
+
+        super().__register__(module_name)
+
+    @classmethod
+    def add_links(cls, links):
+        """Link the (work id, party id) pairs ignoring the existing ones
+
+        The works must be locked so concurrent links do not conflict."""
+        links = set(links)
+        if not links:
+            return
+        work_ids = sorted({w for w, _ in links})
+        for sub_ids in grouped_slice(work_ids):
+            for link in cls.search([('work', 'in', list(sub_ids))]):
+                links.discard((link.work.id, link.party.id))
+        cls.create([{'work': w, 'party': p} for w, p in sorted(links)])
+
+
 class WorkStatus(metaclass=PoolMeta):
     'Work Status'
     __name__ = 'project.work.status'
 
     status_on_stakeholder_action = fields.Many2One('project.work.status',
         'Stakeholder Action')
+    _open_cache = Cache('project.work.status.open', context=False)
+
+    @classmethod
+    def get_open_ids(cls):
+        "Return the ids of the statuses of unfinished works"
+        status_ids = cls._open_cache.get(None)
+        if status_ids is not None:
+            return list(status_ids)
+        status_ids = [s.id for s in cls.search(['OR',
+                    ('progress', '!=', 1),
+                    ('progress', '=', None),
+                    ], order=[])]
+        cls._open_cache.set(None, status_ids)
+        return status_ids
+
+    @classmethod
+    def create(cls, vlist):
+        cls._open_cache.clear()
+        return super().create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        cls._open_cache.clear()
+
+    @classmethod
+    def delete(cls, statuses):
+        super().delete(statuses)
+        cls._open_cache.clear()
 
 
 class ActivityType(metaclass=PoolMeta):
@@ -685,6 +1854,7 @@ class TimesheetLine(metaclass=PoolMeta):
         Activity.save(to_save)
 
     @classmethod
+    @instrument('timesheet.line.sync_activity')
     def sync_activity(cls, lines):
         pool = Pool()
         Activity = pool.get('activity.activity')